@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the streaming chunk path.
+
+The request plan figures are modelled, not measured: every GetFile is
+assumed to cost a round-trip plus the transfer of its limit, with
+STREAM_PREFETCH requests in flight, and the time to first byte and
+throughput of fixed 1 MiB requests are computed against the plans of
+web/utils/chunk_planner.py for seeks and sequential reads. Neither
+ByteStreamer nor send_stream_response runs, so scheduling, sessions,
+caches and socket writes are left out.
+
+The allocation figures are measured with tracemalloc, but only for the
+cutting of the first, middle and last chunks of a range, slicing bytes as
+yield_file used to versus the memoryview slices of cut_chunk, not for the
+rest of the write path.
+
+    python bench_stream.py --rtt 0.12 --bandwidth 8 --prefetch 4
+"""
+import os
+import argparse
+import tracemalloc
+import importlib.util
+
+# Load the planner by path, importing the web package would start the web app
+spec = importlib.util.spec_from_file_location(
+    "chunk_planner", os.path.join(os.path.dirname(os.path.abspath(__file__)), "web", "utils", "chunk_planner.py")
+)
+chunk_planner = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(chunk_planner)
+
+MiB = 1024 * 1024
+
+def fixed_plan(first, last, chunk_size=MiB):
+    offset = first - first % chunk_size
+    return [(part, chunk_size) for part in range(offset, last + 1, chunk_size)]
+
+def simulate(parts, first, last, rtt, bandwidth, prefetch):
+    """Return the modelled time to first byte and throughput of a plan"""
+    finished = []
+    for index, (offset, limit) in enumerate(parts):
+        # A request is sent once the one prefetch places before it is consumed
+        start = finished[index - prefetch] if index >= prefetch else 0
+        finished.append(start + rtt + limit / bandwidth)
+    # Chunks are handed out in order
+    for index in range(1, len(finished)):
+        finished[index] = max(finished[index], finished[index - 1])
+    total = last - first + 1
+    fetched = sum(limit for _, limit in parts)
+    return finished[0], total / finished[-1] / MiB, fetched / total
+
+def bytes_cut(chunk, offset, first, last):
+    # Slicing as yield_file did before cut_chunk
+    return chunk[max(first - offset, 0):last - offset + 1]
+
+def measure_allocations(cut, chunk, offset, first, last, rounds=50):
+    """Return the bytes allocated to cut a chunk and hand it to a writer"""
+    allocated = 0
+    for _ in range(rounds):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        piece = cut(chunk, offset, first, last)
+        len(piece)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+        del piece
+    return allocated / rounds
+
+def bench_allocations():
+    chunk = os.urandom(MiB)
+    offset = 10 * MiB
+    cases = [
+        ("first chunk, seek inside it", offset + 300000, offset + 5 * MiB),
+        ("middle chunk", offset - MiB, offset + 2 * MiB),
+        ("last chunk, range ends inside it", offset - 4 * MiB, offset + 700000),
+    ]
+    print("\nMeasured allocations of cutting one chunk, without the rest of the write path")
+    print(f"\n{'chunk':34} {'cut':10} {'bytes allocated':>16} {'copies':>7}")
+    tracemalloc.start()
+    for name, first, last in cases:
+        size = len(bytes_cut(chunk, offset, first, last))
+        for cut_name, cut in (("bytes", bytes_cut), ("memoryview", chunk_planner.cut_chunk)):
+            allocated = measure_allocations(cut, chunk, offset, first, last)
+            print(f"{name:34} {cut_name:10} {allocated:>16.0f} {allocated / size:>7.2f}")
+    tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rtt", type=float, default=0.12, help="modelled seconds per GetFile round-trip")
+    parser.add_argument("--bandwidth", type=float, default=8, help="modelled MiB/s of one GetFile transfer")
+    parser.add_argument("--prefetch", type=int, default=4, help="GetFile requests in flight")
+    args = parser.parse_args()
+    bandwidth = args.bandwidth * MiB
+
+    file_offset = 1500 * MiB + 123456
+    cases = [
+        ("seek, 64 KiB read (moov atom)", file_offset, file_offset + 64 * 1024 - 1, chunk_planner.SEEK_CHUNK_SIZE),
+        ("seek, 16 MiB read after it", file_offset, file_offset + 16 * MiB - 1, chunk_planner.SEEK_CHUNK_SIZE),
+        # The first range of a viewer counts as a seek, the following ones as sequential
+        ("start, 256 MiB read", 0, 256 * MiB - 1, chunk_planner.SEEK_CHUNK_SIZE),
+        ("sequential, next 256 MiB", 256 * MiB, 512 * MiB - 1, chunk_planner.MAX_CHUNK_SIZE),
+    ]
+    print("Modelled request plans, not measured on the streaming pipeline")
+    print(f"rtt={args.rtt}s bandwidth={args.bandwidth} MiB/s prefetch={args.prefetch}\n")
+    print(f"{'case':34} {'plan':8} {'requests':>8} {'ttfb ms':>8} {'MiB/s':>8} {'fetched':>8}")
+    for name, first, last, start_size in cases:
+        plans = (
+            ("fixed", fixed_plan(first, last)),
+            ("planner", chunk_planner.plan_chunks(first, last, start_size)),
+        )
+        for plan_name, parts in plans:
+            ttfb, throughput, overhead = simulate(parts, first, last, args.rtt, bandwidth, args.prefetch)
+            print(f"{name:34} {plan_name:8} {len(parts):>8} {ttfb * 1000:>8.0f} {throughput:>8.2f} {overhead:>7.2f}x")
+    bench_allocations()
+
+if __name__ == "__main__":
+    main()
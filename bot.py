@@ -105,9 +105,20 @@ class Bot(Client):
                 pass
             os.remove('restart.txt')
         temp.BOT = self
+        # Start the extra streaming clients of MULTI_TOKENS
+        from web.utils.client_pool import start_clients
+        await start_clients(self)
+        # Warm up and health check the media sessions used for streaming
+        from web.utils.media_sessions import media_sessions
+        asyncio.create_task(media_sessions.run())
         # Only create indexes for MongoDB
         if DATABASE_URL and DATABASE_URL.startswith('mongodb'):
-            await Media.ensure_indexes()
+            from database.ia_filterdb import ensure_indexes, prepare_search_index, load_shard_routes
+            await ensure_indexes()
+            await load_shard_routes()
+            # Fill search fields of files indexed by older versions and load
+            # the token filter from them in the background
+            asyncio.create_task(prepare_search_index())
         me = await self.get_me()
         temp.ME = me.id
         temp.U_NAME = me.username
@@ -174,6 +185,8 @@ class Bot(Client):
             print(f"Error processing missed messages: {e}")
 
     async def stop(self, *args):
+        from web.utils.client_pool import stop_clients
+        await stop_clients()
         await super().stop()
         print("Bot Stopped! Bye...")
 
@@ -1,11 +1,17 @@
 import logging
-from struct import pack
+from struct import pack, unpack
 import re
 import base64
+import asyncio
+import hashlib
+import heapq
+from itertools import islice
 from pyrogram.file_id import FileId
 import os
 import json
-from info import USE_CAPTION_FILTER, DATABASE_URL, SECOND_DATABASE_URL, DATABASE_NAME, COLLECTION_NAME, MAX_BTN
+from datetime import datetime
+from info import USE_CAPTION_FILTER, DATABASE_URL, SECOND_DATABASE_URL, DATABASE_NAME, COLLECTION_NAME, MAX_BTN, SEARCH_COUNT_LIMIT, SEARCH_SHARD_TIMEOUT, LANGUAGES, QUALITY, MONGODB_SHARD_NAMES, SHARD_LEGACY_DUP_CHECK
+from database.search_cache import search_cache, token_filter
 # Import needed modules
 from umongo import fields as umongo_fields
 
@@ -46,13 +52,39 @@ if MULTI_MONGODB_URLS:
 # Print MongoDB configuration (redacted for security)
 print(f"Using {len(mongodb_urls)} MongoDB instances")
 
+# Search index settings. Every saved file carries a `search_tokens` array with
+# the prefixes of each word in its name and caption, so searches can narrow the candidates
+# through a multikey index before the word-boundary regex is applied, and
+# `languages` / `qualities` arrays with the LANGUAGES and QUALITY tags found
+# in its name, used by the language and quality buttons, and the typed release
+# fields (year, resolution, source, codec, season, episode) parsed from it.
+# Bump INDEX_VERSION whenever the derived fields change so that
+# backfill_index_fields() recomputes them for existing documents. Captions are
+# tokenized even with USE_CAPTION_FILTER off, so turning it on needs no backfill.
+INDEX_VERSION = 4
+MIN_PREFIX_LEN = 2
+MAX_PREFIX_LEN = 15
+TOKEN_SPLIT_PATTERN = re.compile(r'[\W_]+')
+REGEX_METACHARACTERS = re.compile(r'[?*+|()\[\]{}.^$\\]')
+YEAR_PATTERN = re.compile(r'\b(19\d{2}|20\d{2})\b')
+EPISODE_PATTERN = re.compile(r'S(\d{1,2})\s?E(\d{1,3})', re.IGNORECASE)
+# Stored names have their separators replaced by spaces, so WEB-DL is WEB DL
+RELEASE_PATTERNS = {
+    'resolution': re.compile(r'\b(720p|1080p|2160p|4K|UHD|HD|FULL\s*HD)\b', re.IGNORECASE),
+    'source': re.compile(r'\b(WEB[\s\-]?DL|BLU[\s\-]?RAY|HDRip|DVDRip|CAM|HDCAM|DVD)\b', re.IGNORECASE),
+    'codec': re.compile(r'\b(x264|x265|HEVC|AVC|H[\s\.]?264|H[\s\.]?265)\b', re.IGNORECASE),
+}
+RELEASE_NAMES = {'WEBDL': 'WEB-DL', 'BLURAY': 'BLU-RAY', 'FULLHD': 'FULL HD'}
+RELEASE_FIELDS = ('year', 'resolution', 'source', 'codec', 'season', 'episode')
+
 # Check if we're using PostgreSQL
 if DATABASE_URL and not DATABASE_URL.startswith('mongodb'):
     from database.sql_adapter import db_adapter, Media
     using_postgres = True
 else:
     # Use MongoDB
-    from pymongo.errors import DuplicateKeyError, OperationFailure 
+    from pymongo import UpdateOne
+    from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError
     from umongo import Instance, Document, fields
     from motor.motor_asyncio import AsyncIOMotorClient
     from marshmallow.exceptions import ValidationError
@@ -78,9 +110,24 @@ else:
             file_name = fields.StrField(required=True)
             file_size = fields.IntField(required=True)
             caption = fields.StrField(allow_none=True)
+            search_tokens = fields.ListField(fields.StrField(), allow_none=True)
+            languages = fields.ListField(fields.StrField(), allow_none=True)
+            qualities = fields.ListField(fields.StrField(), allow_none=True)
+            year = fields.IntField(allow_none=True)
+            resolution = fields.StrField(allow_none=True)
+            source = fields.StrField(allow_none=True)
+            codec = fields.StrField(allow_none=True)
+            season = fields.IntField(allow_none=True)
+            episode = fields.IntField(allow_none=True)
+            index_version = fields.IntField(allow_none=True)
+            saved_at = fields.DateTimeField(allow_none=True)
         
             class Meta:
-                indexes = ('$file_name', )
+                indexes = (
+                    '$file_name', 'search_tokens', 'languages', 'qualities',
+                    'resolution', ('year', 'resolution'), ('season', 'episode'),
+                    ('-saved_at', '-_id')
+                )
                 collection_name = COLLECTION_NAME
                 strict = False
         
@@ -98,14 +145,438 @@ else:
         SecondMedia = mongo_models[1]
 
 
+def clean_text(text):
+    """Normalize a file name or caption the same way it is stored"""
+    return re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(text))
+
+def tokenize(text):
+    """Split text into lowercase word tokens"""
+    return [token for token in TOKEN_SPLIT_PATTERN.split(str(text).lower()) if token]
+
+def build_search_tokens(*texts):
+    """Return the sorted prefix keys of every token found in texts"""
+    keys = set()
+    for text in texts:
+        if not text:
+            continue
+        for token in tokenize(text):
+            for length in range(MIN_PREFIX_LEN, min(len(token), MAX_PREFIX_LEN) + 1):
+                keys.add(token[:length])
+    return sorted(keys)
+
+def get_tags(text, tags):
+    """Return the tags found in text, the way the language and quality buttons match them"""
+    text = str(text).lower()
+    return [tag for tag in tags if tag in text]
+
+def normalize_release_value(value):
+    """Return the stored form of a resolution, source or codec"""
+    value = re.sub(r'[\s\.\-]+', '', value.upper())
+    return RELEASE_NAMES.get(value, value)
+
+def get_release_fields(file_name):
+    """Parse the typed release metadata of a file name"""
+    release = dict.fromkeys(RELEASE_FIELDS)
+    file_name = str(file_name)
+    years = YEAR_PATTERN.findall(file_name)
+    if years:
+        # The release year follows the title, which may be a year itself
+        release['year'] = int(years[-1])
+    for field, pattern in RELEASE_PATTERNS.items():
+        match = pattern.search(file_name)
+        if match:
+            release[field] = normalize_release_value(match.group(1))
+    match = EPISODE_PATTERN.search(file_name)
+    if match:
+        release['season'] = int(match.group(1))
+        release['episode'] = int(match.group(2))
+    return release
+
+def get_release_info(file):
+    """Return the stored release metadata of a search result, or None if not computed yet"""
+    if (getattr(file, 'index_version', None) or 0) < 3:
+        return None
+    return {field: getattr(file, field, None) for field in RELEASE_FIELDS}
+
+def parse_release_query(query):
+    """
+    Return the typed field filter of a query made only of release terms,
+    like "S02E05" or "2019 1080p", or None for any other query.
+
+    A field takes one value, so a query naming two of them, like "1080p 720p",
+    is not a release query and is matched on the name like any other.
+    """
+    filter = {}
+    for word in query.split():
+        values = {}
+        episode = re.fullmatch(r's(\d{1,2})e(\d{1,3})', word, re.IGNORECASE)
+        if episode:
+            values = {'season': int(episode.group(1)), 'episode': int(episode.group(2))}
+        elif re.fullmatch(r'(19|20)\d{2}', word):
+            values = {'year': int(word)}
+        else:
+            for field, pattern in RELEASE_PATTERNS.items():
+                if pattern.fullmatch(word):
+                    values = {field: normalize_release_value(word)}
+                    break
+        if not values:
+            return None
+        for field, value in values.items():
+            if filter.setdefault(field, value) != value:
+                return None
+    # A lone source or codec is more likely part of a title
+    if not filter.keys() & {'year', 'resolution', 'season'}:
+        return None
+    return filter
+
+def get_index_fields(file_name, caption=None):
+    """Compute the derived fields stored alongside a media document"""
+    texts = [file_name]
+    if caption and caption != 'None':
+        texts.append(caption)
+    return {
+        'search_tokens': build_search_tokens(*texts),
+        'languages': get_tags(file_name, LANGUAGES),
+        'qualities': get_tags(file_name, QUALITY),
+        **get_release_fields(file_name),
+        'index_version': INDEX_VERSION
+    }
+
+def get_media_fields(media):
+    """Normalize a media object into the fields stored for it"""
+    file_name = clean_text(media.file_name)
+    file_caption = clean_text(media.caption)
+    return dict(
+        file_id=unpack_new_file_id(media.file_id),
+        file_name=file_name,
+        file_size=media.file_size,
+        caption=file_caption,
+        saved_at=datetime.utcnow(),
+        **get_index_fields(file_name, file_caption if media.caption else None)
+    )
+
+def get_query_keys(query):
+    """
+    Return the token prefixes every document matching `query` must contain.
+
+    A single word query only matches between word boundaries, so its leading
+    word is a prefix of a token. In a multi word query the first word may match
+    anywhere, but every following word starts right after a separator, so only
+    those words are used as keys.
+
+    Queries are regexes, so a word with metacharacters may match text that
+    doesn't contain it literally ("colou?r" matches "color") and is left out.
+    An alternation can make any word optional, so it leaves no keys at all.
+    """
+    if '|' in query:
+        return []
+    words = [query] if ' ' not in query else query.split(' ')[1:]
+    keys = []
+    for word in words:
+        if REGEX_METACHARACTERS.search(word):
+            continue
+        match = re.match(r'[^\W_]+', word.lower())
+        if match and len(match.group()) >= MIN_PREFIX_LEN:
+            key = match.group()[:MAX_PREFIX_LEN]
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+def build_search_filter(query, use_caption=USE_CAPTION_FILTER):
+    """Build the MongoDB filter for a search query"""
+    if not query:
+        raw_pattern = '.'
+    elif ' ' not in query:
+        raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
+    else:
+        raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]')
+    try:
+        regex = re.compile(raw_pattern, flags=re.IGNORECASE)
+    except:
+        regex = query
+
+    if use_caption:
+        filter = {'$or': [{'file_name': regex}, {'caption': regex}]}
+    else:
+        filter = {'file_name': regex}
+
+    keys = get_query_keys(query) if query else []
+    if not keys:
+        return filter
+    # The token index narrows the candidates, the regex keeps the exact
+    # word-boundary and word order semantics. Documents saved before the
+    # tokens existed are still matched until the backfill reaches them.
+    return {'$and': [
+        {'$or': [{'search_tokens': {'$all': keys}}, {'search_tokens': None}]},
+        filter
+    ]}
+
+def build_query_filter(query):
+    """Build the MongoDB filter of a search, also on the typed release fields for release-only queries"""
+    filter = build_search_filter(query)
+    release = parse_release_query(query) if query else None
+    if release is None:
+        return filter
+    # The name match still finds titles that look like release terms, like
+    # "1917" or "2012", and the files saved before the typed fields existed
+    return {'$or': [release, filter]}
+
+def get_match_keys(query):
+    """Return the token keys used to cache a search and check it against the token filter"""
+    if not using_postgres and query and parse_release_query(query) is not None:
+        # Also matched on the typed fields, whose values need not be tokens of the name
+        return []
+    return get_query_keys(query)
+
+def build_tag_filter(tag):
+    """Build the MongoDB filter for files with a language or quality tag"""
+    tag = tag.lower()
+    regex = re.compile(re.escape(tag), flags=re.IGNORECASE)
+    for field, tags in (('languages', LANGUAGES), ('qualities', QUALITY)):
+        if tag in tags:
+            # Files saved before the tags existed are matched by name until backfilled
+            return {'$or': [{field: tag}, {field: None, 'file_name': regex}]}
+    return {'file_name': regex}
+
+async def ensure_indexes():
+    """Create the configured indexes on every MongoDB instance"""
+    if using_postgres:
+        return
+    for i, model in enumerate(mongo_models):
+        try:
+            await model.ensure_indexes()
+        except Exception as e:
+            print(f"Error creating indexes in DB #{i+1}: {e}")
+
+# Files are routed to a MongoDB instance by hashing their file_id into one of
+# ROUTING_BUCKETS buckets and picking the instance with the highest rendezvous
+# score for that bucket, so adding an instance only moves ~1/N of the buckets.
+# shard_routes holds (first_bucket, last_bucket, instance index) overrides for
+# bucket ranges that were migrated to another instance. Instances are scored by
+# their MONGODB_SHARD_NAMES name, so editing a URL doesn't move any file.
+ROUTING_BUCKETS = 1024
+shard_keys = [
+    MONGODB_SHARD_NAMES[i] if i < len(MONGODB_SHARD_NAMES) else f'db{i+1}'
+    for i in range(len(mongodb_urls))
+]
+shard_routes = []
+
+def get_routing_bucket(file_id):
+    """Return the routing bucket of an unpacked file_id"""
+    digest = hashlib.sha1(file_id.encode()).digest()
+    return int.from_bytes(digest[:4], 'big') % ROUTING_BUCKETS
+
+def _rendezvous_score(bucket, shard_key):
+    digest = hashlib.sha1(f'{shard_key}:{bucket}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+def get_shard_index(file_id):
+    """Return the index of the MongoDB instance a file_id belongs to"""
+    bucket = get_routing_bucket(file_id)
+    for first, last, index in shard_routes:
+        if first <= bucket <= last and index < len(mongo_models):
+            return index
+    return max(range(len(mongo_models)), key=lambda i: _rendezvous_score(bucket, shard_keys[i]))
+
+async def find_saved_elsewhere(file_ids):
+    """Return the file_ids already stored on an instance other than their home one"""
+    if len(mongo_models) <= 1 or not file_ids:
+        return set()
+    homes = {file_id: get_shard_index(file_id) for file_id in file_ids}
+    others = [
+        (i, [file_id for file_id in file_ids if homes[file_id] != i])
+        for i in range(len(mongo_models))
+    ]
+    shard_results = await asyncio.gather(*[
+        query_shard(
+            i,
+            mongo_models[i].collection.find({'_id': {'$in': ids}}, {'_id': 1}).to_list(length=len(ids)),
+            [], 'checking duplicates'
+        )
+        for i, ids in others if ids
+    ])
+    return {doc['_id'] for docs in shard_results for doc in docs}
+
+async def load_shard_routes():
+    """Load the routing overrides stored in the primary database"""
+    if using_postgres or not mongo_dbs:
+        return
+    routes = await mongo_dbs[0].shard_routes.find().sort('first_bucket', 1).to_list(length=None)
+    shard_routes[:] = [(route['first_bucket'], route['last_bucket'], route['instance']) for route in routes]
+    if shard_routes:
+        print(f"Loaded {len(shard_routes)} shard routing overrides")
+
+async def set_shard_route(first_bucket, last_bucket, instance):
+    """Route the buckets first_bucket..last_bucket to the MongoDB instance with the given index"""
+    await mongo_dbs[0].shard_routes.update_one(
+        {'first_bucket': first_bucket, 'last_bucket': last_bucket},
+        {'$set': {'instance': instance}},
+        upsert=True
+    )
+    await load_shard_routes()
+
+# Number of times each MongoDB instance was skipped because it timed out or failed
+shard_skips = {}
+
+async def query_shard(i, coro, default, action, timeout=SEARCH_SHARD_TIMEOUT):
+    """Await a query on MongoDB instance #i, returning default if it is too slow or fails"""
+    try:
+        if timeout:
+            return await asyncio.wait_for(coro, timeout=timeout)
+        return await coro
+    except asyncio.TimeoutError:
+        skips = shard_skips.setdefault(i, {'timeouts': 0, 'errors': 0})
+        skips['timeouts'] += 1
+        print(f"DB #{i+1} timed out while {action}, skipping it")
+    except Exception as e:
+        skips = shard_skips.setdefault(i, {'timeouts': 0, 'errors': 0})
+        skips['errors'] += 1
+        print(f"Error {action} in DB #{i+1}: {e}")
+    return default
+
+async def query_all_shards(make_query, default, action, timeout=SEARCH_SHARD_TIMEOUT):
+    """Run make_query(model) on every MongoDB instance concurrently"""
+    return await asyncio.gather(*[
+        query_shard(i, make_query(model), default, action, timeout=timeout)
+        for i, model in enumerate(mongo_models)
+    ])
+
+def count_shard_skips():
+    """Return how many times any instance was skipped so far"""
+    return sum(skips['timeouts'] + skips['errors'] for skips in shard_skips.values())
+
+# Search results are ordered newest first by the time they were saved. Files
+# saved before saved_at existed have none and come last, newest _id first,
+# which is also how MongoDB sorts a missing field.
+SEARCH_SORT = [('saved_at', -1), ('_id', -1)]
+
+def get_sort_key(doc):
+    """Return the SEARCH_SORT key of a document, comparable across instances"""
+    saved_at = getattr(doc, 'saved_at', None)
+    return (saved_at is not None, saved_at or datetime.min, doc.file_id)
+
+def build_after_filter(doc):
+    """Build the filter of the documents that come after doc in SEARCH_SORT order"""
+    saved_at = getattr(doc, 'saved_at', None)
+    if saved_at is None:
+        return {'saved_at': None, '_id': {'$lt': doc.file_id}}
+    return {'$or': [
+        {'saved_at': {'$lt': saved_at}},
+        {'saved_at': saved_at, '_id': {'$lt': doc.file_id}},
+        {'saved_at': None}
+    ]}
+
+def merge_shard_results(shard_results):
+    """Merge per instance results in SEARCH_SORT order into one ordered stream without duplicates"""
+    last_id = None
+    for doc in heapq.merge(*shard_results, key=get_sort_key, reverse=True):
+        if doc.file_id == last_id:
+            continue
+        last_id = doc.file_id
+        yield doc
+
+async def count_distinct_results(filter):
+    """Count the files matching filter up to SEARCH_COUNT_LIMIT, once even if stored on several instances"""
+    if len(mongo_models) <= 1:
+        counts = await query_all_shards(
+            lambda model: model.count_documents(filter, limit=SEARCH_COUNT_LIMIT),
+            0, 'counting results'
+        )
+        return sum(counts)
+    # Files indexed before routing may be stored twice, count their ids
+    shard_ids = await query_all_shards(
+        lambda model: model.collection.find(filter, {'_id': 1}).limit(SEARCH_COUNT_LIMIT).to_list(length=SEARCH_COUNT_LIMIT),
+        [], 'counting results'
+    )
+    return min(len({doc['_id'] for ids in shard_ids for doc in ids}), SEARCH_COUNT_LIMIT)
+
+# Held while a backfill runs, so the startup one and /backfill don't overlap
+backfill_lock = asyncio.Lock()
+
+async def backfill_index_fields(batch_size=500):
+    """Compute the derived search fields for documents saved by older versions"""
+    if using_postgres:
+        return 0
+    async with backfill_lock:
+        total = await _backfill_index_fields(batch_size)
+    if total:
+        # Typed field searches and tag counts may now match more files
+        search_cache.clear()
+    return total
+
+async def _backfill_index_fields(batch_size):
+    stale = {'index_version': {'$not': {'$gte': INDEX_VERSION}}}
+    total = 0
+    for i, model in enumerate(mongo_models):
+        updated = 0
+        try:
+            cursor = model.collection.find(stale, projection={'file_name': 1, 'caption': 1})
+            ops = []
+            async for doc in cursor:
+                index_fields = get_index_fields(doc.get('file_name', ''), doc.get('caption'))
+                ops.append(UpdateOne({'_id': doc['_id']}, {'$set': index_fields}))
+                if len(ops) >= batch_size:
+                    await model.collection.bulk_write(ops, ordered=False)
+                    updated += len(ops)
+                    ops = []
+                    # Give search requests a chance to run between batches
+                    await asyncio.sleep(0)
+            if ops:
+                await model.collection.bulk_write(ops, ordered=False)
+                updated += len(ops)
+        except Exception as e:
+            print(f"Error backfilling index fields in DB #{i+1}: {e}")
+        if updated:
+            print(f"Backfilled index fields of {updated} files in DB #{i+1}")
+        total += updated
+    return total
+
+def add_search_tokens(tokens):
+    """Record the search tokens of a saved file and drop the cached results it may change"""
+    for token in tokens:
+        token_filter.add(token)
+    search_cache.invalidate(tokens)
+
+async def load_token_filter():
+    """Add the search tokens of every indexed file to the token filter"""
+    if using_postgres:
+        return
+    for i, model in enumerate(mongo_models):
+        try:
+            # The filter can't vouch for files whose tokens are not computed yet
+            if await model.count_documents({'search_tokens': None}, limit=1):
+                print(f"DB #{i+1} has files without search tokens, not using the token filter")
+                return
+            cursor = model.collection.aggregate([
+                {'$project': {'search_tokens': 1}},
+                {'$unwind': '$search_tokens'},
+                {'$group': {'_id': '$search_tokens'}}
+            ], allowDiskUse=True)
+            added = 0
+            async for doc in cursor:
+                token_filter.add(doc['_id'])
+                added += 1
+                if not added % 10000:
+                    await asyncio.sleep(0)
+        except Exception as e:
+            print(f"Error loading search tokens from DB #{i+1}: {e}")
+            return
+    token_filter.ready = True
+    print(f"Loaded {token_filter.tokens} search tokens into the token filter")
+
+async def prepare_search_index():
+    """Backfill the derived search fields, then load the token filter from them"""
+    await backfill_index_fields()
+    await load_token_filter()
+
 async def save_file(media):
     """Save file in database with support for multiple MongoDB instances"""
     
     if using_postgres:
         # PostgreSQL version
         file_id = unpack_new_file_id(media.file_id)
-        file_name = re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(media.file_name))
-        file_caption = re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(media.caption))
+        file_name = clean_text(media.file_name)
+        file_caption = clean_text(media.caption)
         
         media_data = {
             "file_id": file_id,
@@ -117,6 +588,7 @@ async def save_file(media):
         result = db_adapter.save_file(media_data)
         if result:
             print(f'Saved - {file_name}')
+            add_search_tokens(get_index_fields(file_name, file_caption if media.caption else None)['search_tokens'])
             return 'suc'
         else:
             print(f'Already Saved - {file_name}')
@@ -124,35 +596,32 @@ async def save_file(media):
     else:
         # MongoDB version
         # TODO: Find better way to get same file_id for same media to avoid duplicates
-        file_id = unpack_new_file_id(media.file_id)
-        file_name = re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(media.file_name))
-        file_caption = re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(media.caption))
+        media_fields = get_media_fields(media)
+        file_id = media_fields['file_id']
+        file_name = media_fields['file_name']
         
-        # Check if file exists in any database first (to avoid duplicate attempts)
-        for i, model in enumerate(mongo_models):
-            try:
-                exists = await model.find_one({'_id': file_id})
-                if exists:
-                    print(f'Already saved in DB #{i+1} - {file_name}')
-                    return 'dup'
-            except Exception as e:
-                print(f'Error checking DB #{i+1}: {e}')
+        # Every file_id has a home instance, so the unique _id index there is
+        # the duplicate check and the insert costs a single round-trip
+        home = get_shard_index(file_id)
+        order = [home] + [i for i in range(len(mongo_models)) if i != home]
+        
+        # Files saved before routing may be on any other instance
+        if SHARD_LEGACY_DUP_CHECK and file_id in await find_saved_elsewhere([file_id]):
+            print(f'Already saved in another DB - {file_name}')
+            return 'dup'
         
-        # Try to save to each database in order until successful
-        for i, model in enumerate(mongo_models):
+        # Fall back to the other databases only if the home one refuses the write
+        for i in order:
+            model = mongo_models[i]
             try:
-                file = model(
-                    file_id=file_id,
-                    file_name=file_name,
-                    file_size=media.file_size,
-                    caption=file_caption
-                )
+                file = model(**media_fields)
                 await file.commit()
                 print(f'Saved to DB #{i+1} - {file_name}')
+                add_search_tokens(media_fields['search_tokens'])
                 return 'suc'
             except ValidationError:
                 print(f'Validation error in DB #{i+1} - {file_name}')
-                continue
+                return 'err'
             except DuplicateKeyError:
                 print(f'Already saved in DB #{i+1} - {file_name}')
                 return 'dup'
@@ -167,14 +636,72 @@ async def save_file(media):
         print(f'Failed to save to any database - {file_name}')
         return 'err'
 
-async def get_search_results(query, max_results=MAX_BTN, offset=0, lang=None):
-    """Search for files across all configured MongoDB instances"""
-    query = str(query) # to ensure the query is string to stripe.
-    query = query.strip()
-    
+async def save_files(batch):
+    """
+    Save a batch of get_media_fields() dicts with one bulk insert per database
+
+    Returns:
+        Tuple of (saved, duplicate, errors)
+    """
+    if using_postgres:
+        saved = duplicate = 0
+        for media_data in batch:
+            if db_adapter.save_file(media_data):
+                saved += 1
+                add_search_tokens(media_data['search_tokens'])
+            else:
+                duplicate += 1
+        return saved, duplicate, 0
+
+    errors = duplicate = 0
+    if SHARD_LEGACY_DUP_CHECK:
+        # Files saved before routing may be on any other instance
+        saved_elsewhere = await find_saved_elsewhere([media_fields['file_id'] for media_fields in batch])
+        duplicate = sum(1 for media_fields in batch if media_fields['file_id'] in saved_elsewhere)
+        batch = [media_fields for media_fields in batch if media_fields['file_id'] not in saved_elsewhere]
+    groups = {}
+    for media_fields in batch:
+        i = get_shard_index(media_fields['file_id'])
+        try:
+            groups.setdefault(i, []).append(mongo_models[i](**media_fields).to_mongo())
+        except ValidationError:
+            print(f"Validation error - {media_fields['file_name']}")
+            errors += 1
+
+    async def insert(i, docs):
+        try:
+            result = await mongo_models[i].collection.insert_many(docs, ordered=False)
+            return len(result.inserted_ids), 0, 0
+        except BulkWriteError as e:
+            # Unordered inserts keep going past duplicates, only count them
+            write_errors = e.details.get('writeErrors', [])
+            duplicate = sum(1 for error in write_errors if error.get('code') == 11000)
+            return e.details.get('nInserted', 0), duplicate, len(write_errors) - duplicate
+        except Exception as e:
+            print(f'Error saving batch to DB #{i+1}: {e}')
+            return 0, 0, len(docs)
+
+    results = await asyncio.gather(*[insert(i, docs) for i, docs in groups.items()])
+    saved = sum(result[0] for result in results)
+    duplicate += sum(result[1] for result in results)
+    errors += sum(result[2] for result in results)
+    if saved:
+        # Unordered inserts don't say which files were new, invalidate for all
+        for docs in groups.values():
+            for doc in docs:
+                add_search_tokens(doc.get('search_tokens') or [])
+    return saved, duplicate, errors
+
+async def fetch_search_results(query, window, lang=None, after=None):
+    """
+    Return the first window files matching a query, newest first, and the
+    total count. With after, return the window files that follow that file
+    and None for the count.
+    """
     if using_postgres:
         # PostgreSQL version
-        results = db_adapter.get_search_results(query, max_results=max_results, offset=offset)
+        results = db_adapter.get_search_results(query, max_results=window, offset=0, tag=lang)
+        total_results = db_adapter.count_search_results(query, limit=SEARCH_COUNT_LIMIT, tag=lang)
         
         # Convert PostgreSQL results to match MongoDB format
         files = []
@@ -192,68 +719,118 @@ async def get_search_results(query, max_results=MAX_BTN, offset=0, lang=None):
             file_obj = FileObject(**file_dict)
             files.append(file_obj)
         
-        # Handle language filtering if specified
-        if lang:
-            lang_files = [file for file in files if lang in file.file_name.lower()]
-            filtered_files = lang_files[:max_results]
-            total_results = len(lang_files)
-            next_offset = offset + max_results
-            if next_offset >= total_results:
-                next_offset = ''
-            return filtered_files, next_offset, total_results
-        
-        total_results = len(files)
-        next_offset = offset + max_results
-        if next_offset >= total_results:
-            next_offset = ''
-        return files, next_offset, total_results
+        return files, total_results
     else:
         # MongoDB version
-        if not query:
-            raw_pattern = '.'
-        elif ' ' not in query:
-            raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
-        else:
-            raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]') 
-        try:
-            regex = re.compile(raw_pattern, flags=re.IGNORECASE)
-        except:
-            regex = query
+        filter = build_query_filter(query)
+        if lang:
+            filter = {'$and': [filter, build_tag_filter(lang)]}
+        
+        # Every file after the last one already shown sorts below it on all
+        # instances, so the next page is a keyset query of window files each
+        page_filter = {'$and': [filter, build_after_filter(after)]} if after is not None else filter
     
-        if USE_CAPTION_FILTER:
-            filter = {'$or': [{'file_name': regex}, {'caption': regex}]}
-        else:
-            filter = {'file_name': regex}
+        # Query every MongoDB instance concurrently. Each one returns its first
+        # window matches newest first, which are merged into a single ordered
+        # list; slow instances are skipped instead of waited on.
+        search = query_all_shards(
+            lambda model: model.find(page_filter, sort=SEARCH_SORT, limit=window).to_list(length=window),
+            [], 'searching'
+        )
+        if after is not None:
+            shard_results = await search
+            return list(islice(merge_shard_results(shard_results), window)), None
+        total_results, shard_results = await asyncio.gather(count_distinct_results(filter), search)
+        return list(islice(merge_shard_results(shard_results), window)), total_results
+
+async def get_search_results(query, max_results=MAX_BTN, offset=0, lang=None):
+    """Search for files across all configured MongoDB instances"""
+    query = str(query) # to ensure the query is string to stripe.
+    query = query.strip()
+    window = offset + max_results
     
-        # Search across all MongoDB instances
-        results = []
-        for i, model in enumerate(mongo_models):
-            try:
-                cursor = model.find(filter)
-                db_results = [doc async for doc in cursor]
-                if db_results:
-                    print(f"Found {len(db_results)} results in DB #{i+1}")
-                    results.extend(db_results)
-            except Exception as e:
-                print(f"Error searching DB #{i+1}: {e}")
+    # Repeated queries are answered from the shared cache, which holds the
+    # first files of a query until a write touching its tokens drops them.
+    # Postgres matches substrings, so a new file holding "man" inside
+    # "Superman" wouldn't drop the results of "man", and nothing is cached.
+    key = search_cache.make_key(query, lang)
+    keys = get_match_keys(query)
+    entry = None if using_postgres else search_cache.get(key, window)
+    if entry is not None:
+        files, total_results = entry.files, entry.total
+    elif not token_filter.may_match(keys):
+        # No indexed file has one of the words a match needs
+        return [], '', 0
+    else:
+        generation = search_cache.generation
+        skips = count_shard_skips()
+        partial = search_cache.get_entry(key)
+        if partial is not None and partial.files and not using_postgres:
+            # The first pages are cached, fetch only the files after them
+            more, _ = await fetch_search_results(query, window - len(partial.files), lang, after=partial.files[-1])
+            files, total_results = partial.files + more, partial.total
+        else:
+            files, total_results = await fetch_search_results(query, window, lang)
+        # Results missing a skipped instance are served but not cached
+        if count_shard_skips() == skips and not using_postgres:
+            search_cache.put(key, files, total_results, keys, generation)
+    files = files[offset:window]
     
-        if lang:
-            lang_files = [file for file in results if lang in file.file_name.lower()]
-            files = lang_files[offset:][:max_results]
-            total_results = len(lang_files)
-            next_offset = offset + max_results
-            if next_offset >= total_results:
-                next_offset = ''
-            return files, next_offset, total_results
-            
-        total_results = len(results)
-        files = results[offset:][:max_results]
-        next_offset = offset + max_results
-        if next_offset >= total_results:
-            next_offset = ''   
-        return files, next_offset, total_results
+    next_offset = offset + max_results
+    if next_offset >= total_results:
+        next_offset = ''   
+    return files, next_offset, total_results
     
     
+async def get_search_facets(query):
+    """
+    Return how many files matching a query have each language and quality tag
+
+    Returns:
+        Dict with 'languages' and 'qualities' dicts of tag -> count, in the
+        order of LANGUAGES and QUALITY
+    """
+    query = str(query).strip()
+    facets = {'languages': {}, 'qualities': {}}
+    key = search_cache.make_key(query)
+    entry = search_cache.get_entry(key)
+    if entry is not None and entry.facets is not None:
+        return entry.facets
+    if not token_filter.may_match(get_match_keys(query)):
+        return facets
+
+    generation = search_cache.generation
+    skips = count_shard_skips()
+    if using_postgres:
+        facets['languages'] = db_adapter.count_tags(query, LANGUAGES)
+        facets['qualities'] = db_adapter.count_tags(query, QUALITY)
+    else:
+        # Counted over the same SEARCH_COUNT_LIMIT matches as the totals
+        pipeline = [
+            {'$match': build_query_filter(query)},
+            {'$limit': SEARCH_COUNT_LIMIT},
+            {'$facet': {
+                field: [{'$unwind': f'${field}'}, {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}]
+                for field in facets
+            }}
+        ]
+        shard_results = await query_all_shards(
+            lambda model: model.collection.aggregate(pipeline).to_list(length=1),
+            [], 'counting tags'
+        )
+        for result in shard_results:
+            for field, groups in (result[0] if result else {}).items():
+                for group in groups:
+                    facets[field][group['_id']] = facets[field].get(group['_id'], 0) + group['count']
+        facets['languages'] = {tag: facets['languages'].get(tag, 0) for tag in LANGUAGES}
+        facets['qualities'] = {tag: facets['qualities'].get(tag, 0) for tag in QUALITY}
+
+    # Kept with the cached results of the query, and dropped along with them
+    entry = search_cache.get_entry(key)
+    if entry is not None and generation == search_cache.generation and count_shard_skips() == skips:
+        entry.facets = facets
+    return facets
+
 async def delete_files(query):
     """Delete files across all MongoDB instances that match the query"""
     query = query.strip()
@@ -261,6 +838,9 @@ async def delete_files(query):
     if using_postgres:
         # PostgreSQL version
         total = db_adapter.delete_files(query)
+        if total:
+            # The deleted files are not returned, so their tokens are unknown
+            search_cache.clear()
         # Return minimal info needed for the response
         class FilesCursor:
             def __init__(self, count):
@@ -272,40 +852,26 @@ async def delete_files(query):
         return total, FilesCursor(total)
     else:
         # MongoDB version
-        if not query:
-            raw_pattern = '.'
-        elif ' ' not in query:
-            raw_pattern = r'(\b|[\.\+\-_])' + query + r'(\b|[\.\+\-_])'
-        else:
-            raw_pattern = query.replace(' ', r'.*[\s\.\+\-_]')
-        
-        try:
-            regex = re.compile(raw_pattern, flags=re.IGNORECASE)
-        except:
-            regex = query
+        filter = build_search_filter(query, use_caption=False)
+
+        async def delete_from(model):
+            # Get file names for reporting, then delete the files
+            files = await model.find(filter).to_list(length=None)
+            if files:
+                await model.collection.delete_many(filter)
+            for file in files:
+                search_cache.invalidate(getattr(file, 'search_tokens', None) or get_index_fields(file.file_name, file.caption)['search_tokens'])
+            return [file.file_name for file in files]
         
-        filter = {'file_name': regex}
-        total_deleted = 0
+        # Delete from all MongoDB instances concurrently. Deletes are not
+        # abandoned on a timeout, a failing instance is only reported.
+        results = await query_all_shards(delete_from, [], 'deleting files', timeout=None)
         deleted_filenames = []
-        
-        # Delete from all MongoDB instances
-        for i, model in enumerate(mongo_models):
-            try:
-                # Count documents before deletion
-                db_total = await model.count_documents(filter)
-                if db_total > 0:
-                    # Get file names for reporting
-                    cursor = model.find(filter)
-                    files = [doc async for doc in cursor]
-                    for file in files:
-                        deleted_filenames.append(file.file_name)
-                    
-                    # Delete the files
-                    await model.collection.delete_many(filter)
-                    print(f"Deleted {db_total} files from DB #{i+1}")
-                    total_deleted += db_total
-            except Exception as e:
-                print(f"Error deleting from DB #{i+1}: {e}")
+        for i, filenames in enumerate(results):
+            if filenames:
+                print(f"Deleted {len(filenames)} files from DB #{i+1}")
+                deleted_filenames.extend(filenames)
+        total_deleted = len(deleted_filenames)
         
         # Return results in format expected by the bot
         class FilesCursor:
@@ -340,22 +906,29 @@ async def get_file_details(query):
             
         return results
     else:
-        # MongoDB version - search all databases
+        # MongoDB version - look in the home database of the file first
         filter = {'file_id': query}
         results = []
         
-        # Search in all MongoDB instances
-        for i, model in enumerate(mongo_models):
-            try:
-                cursor = model.find(filter)
-                files = await cursor.to_list(length=1)
-                if files:
-                    print(f"Found file details in DB #{i+1}")
-                    results.extend(files)
-                    # If we found the file, no need to check other DBs
-                    break
-            except Exception as e:
-                print(f"Error getting file details from DB #{i+1}: {e}")
+        if not mongo_models:
+            return results
+        home = get_shard_index(query)
+        files = await query_shard(home, mongo_models[home].find(filter).to_list(length=1), [], 'getting file details')
+        if files:
+            return files
+        
+        # Files saved before routing existed may live in any other database
+        others = [i for i in range(len(mongo_models)) if i != home]
+        shard_results = await asyncio.gather(*[
+            query_shard(i, mongo_models[i].find(filter).to_list(length=1), [], 'getting file details')
+            for i in others
+        ])
+        for i, files in zip(others, shard_results):
+            if files:
+                print(f"Found file details in DB #{i+1}")
+                results.extend(files)
+                # The first instance holding the file wins
+                break
         
         return results
 
@@ -386,6 +959,34 @@ def unpack_new_file_id(new_file_id):
     )
     return file_id
 
+def decode_file_id(file_id: str) -> bytes:
+    """Reverse encode_file_id"""
+    data = base64.urlsafe_b64decode(file_id + "=" * (-len(file_id) % 4))
+    r = b""
+    zero = False
+    for i in data:
+        if zero:
+            r += b"\x00" * i
+            zero = False
+        elif i == 0:
+            zero = True
+        else:
+            r += bytes([i])
+    return r
+
+async def get_catalog_dc_ids(sample_size=500):
+    """Return the DCs holding the files of a random sample of the catalog"""
+    if using_postgres:
+        return []
+    dc_ids = set()
+    for model in mongo_models:
+        try:
+            async for doc in model.collection.aggregate([{'$sample': {'size': sample_size}}, {'$project': {'_id': 1}}]):
+                dc_ids.add(unpack("<ii", decode_file_id(doc['_id'])[:8])[1])
+        except Exception as e:
+            print(f"Error sampling file DCs: {e}")
+    return sorted(dc_ids)
+
 async def get_mood_results(primary_keyword, additional_keywords=None, offset=0, max_results=MAX_BTN):
     """
     Search for content based on mood keywords
@@ -0,0 +1,56 @@
+"""
+Checkpoints of channel indexing jobs.
+
+A checkpoint records the last message id of a channel whose files are
+already written to the database, together with the job counters, so an
+interrupted /index can resume from there instead of starting over.
+"""
+import time
+import logging
+from info import DATABASE_URL, DATABASE_NAME
+
+logger = logging.getLogger(__name__)
+
+class IndexCheckpoints:
+    def __init__(self):
+        self.col = None
+        # Checkpoints are only kept when MongoDB is the main database
+        if DATABASE_URL and DATABASE_URL.startswith('mongodb'):
+            from motor.motor_asyncio import AsyncIOMotorClient
+            self.client = AsyncIOMotorClient(DATABASE_URL)
+            self.col = self.client[DATABASE_NAME].index_checkpoints
+
+    async def get_checkpoint(self, chat):
+        """Return the checkpoint of a channel, or None"""
+        if self.col is None:
+            return None
+        try:
+            return await self.col.find_one({'_id': str(chat)})
+        except Exception as e:
+            logger.error(f"Error loading index checkpoint of {chat}: {e}")
+            return None
+
+    async def save_checkpoint(self, chat, position, stats):
+        """Store the last fully written message id and the counters of a running job"""
+        if self.col is None:
+            return
+        try:
+            await self.col.update_one(
+                {'_id': str(chat)},
+                {'$set': {'position': position, 'stats': stats, 'updated_at': time.time()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.error(f"Error saving index checkpoint of {chat}: {e}")
+
+    async def delete_checkpoint(self, chat):
+        """Forget the checkpoint of a finished job"""
+        if self.col is None:
+            return
+        try:
+            await self.col.delete_one({'_id': str(chat)})
+        except Exception as e:
+            logger.error(f"Error deleting index checkpoint of {chat}: {e}")
+
+# Initialize the database singleton
+index_checkpoints = IndexCheckpoints()
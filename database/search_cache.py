@@ -0,0 +1,207 @@
+"""
+Cache of search results shared by every caller of get_search_results.
+
+Entries map a normalized query to the ordered files fetched for it and the
+total count. Every entry is indexed under the token prefixes a matching
+file must contain, so saving or deleting a file only invalidates the
+queries whose keys are all among the tokens of that file. Queries without
+keys can match any file and are invalidated by every write.
+
+The LRU of results is bounded by the number of files it holds across all
+entries, since one broad query can store far more than many narrow ones.
+Queries without results are kept apart, in their own bounded LRU, so group
+chatter can't evict the results of real searches. In front of both, a
+bloom filter of the search tokens of every indexed file rejects queries
+with a key no file has, without a database round-trip.
+"""
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set
+from info import SEARCH_CACHE_RESULTS, SEARCH_CACHE_TTL, SEARCH_NEGATIVE_CACHE_SIZE, SEARCH_BLOOM_CAPACITY
+
+class SearchCacheEntry:
+    __slots__ = ('files', 'total', 'keys', 'expires', 'facets')
+
+    def __init__(self, files: list, total: int, keys: List[str], expires: float):
+        self.files = files
+        self.total = total
+        self.keys = keys
+        self.expires = expires
+        # Language and quality counts, filled in when first asked for
+        self.facets: Optional[dict] = None
+
+class TokenFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """Bloom filter of the search tokens of every indexed file"""
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / max(capacity, 1) * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.tokens = 0
+        self.rejected = 0
+        # Only consulted once it holds the tokens of the whole catalog
+        self.ready = False
+
+    def get_positions(self, token: str) -> List[int]:
+        digest = hashlib.blake2b(token.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, token: str):
+        new = False
+        for position in self.get_positions(token):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        self.tokens += new
+
+    def __contains__(self, token: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.get_positions(token))
+
+    def may_match(self, keys: List[str]) -> bool:
+        """Return False if some file token a match needs was never indexed"""
+        if not self.ready or all(key in self for key in keys):
+            return True
+        self.rejected += 1
+        return False
+
+    def get_stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'tokens': self.tokens,
+            'rejected': self.rejected,
+            'size_bytes': len(self.bits),
+            'hashes': self.hashes,
+        }
+
+class SearchCache:
+    def __init__(self, max_results: int, max_empty: int, ttl: int):
+        self.max_results = max_results
+        self.max_empty = max_empty
+        self.ttl = ttl
+        self.entries: "OrderedDict[tuple, SearchCacheEntry]" = OrderedDict()
+        self.empty: "OrderedDict[tuple, SearchCacheEntry]" = OrderedDict()
+        # Token prefix -> cache keys of the entries indexed under it
+        self.by_token: Dict[str, Set[tuple]] = {}
+        self.unkeyed: Set[tuple] = set()
+        # Files held by the entries with results
+        self.results = 0
+        # Bumped by every invalidation, results fetched across one are not stored
+        self.generation = 0
+        self.hits = 0
+        self.empty_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(query: str, lang: Optional[str] = None) -> tuple:
+        # Searches ignore case, but a backslash may start a regex escape
+        if '\\' not in query:
+            query = query.lower()
+        return (query, lang)
+
+    def get(self, key: tuple, window: int) -> Optional[SearchCacheEntry]:
+        """Return the entry of a query if it holds its first window files"""
+        pool = self.empty if key in self.empty else self.entries
+        entry = pool.get(key)
+        if entry is not None and entry.expires < time.time():
+            self.remove(key)
+            entry = None
+        if entry is None or (len(entry.files) < window and len(entry.files) < entry.total):
+            self.misses += 1
+            return None
+        pool.move_to_end(key)
+        if entry.total:
+            self.hits += 1
+        else:
+            self.empty_hits += 1
+        return entry
+
+    def put(self, key: tuple, files: list, total: int, keys: List[str], generation: int):
+        if generation != self.generation:
+            return
+        if total and not 0 < len(files) <= self.max_results or not total and not self.max_empty:
+            return
+        self.remove(key)
+        pool = self.entries if total else self.empty
+        pool[key] = SearchCacheEntry(files, total, keys, time.time() + self.ttl)
+        if total:
+            self.results += len(files)
+        if keys:
+            for token in keys:
+                self.by_token.setdefault(token, set()).add(key)
+        else:
+            self.unkeyed.add(key)
+        while self.results > self.max_results or len(self.empty) > self.max_empty:
+            self.remove(next(iter(self.entries if self.results > self.max_results else self.empty)))
+            self.evictions += 1
+
+    def get_entry(self, key: tuple) -> Optional[SearchCacheEntry]:
+        """Return the entry of a query without counting a lookup"""
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.empty.get(key)
+        if entry is not None and entry.expires < time.time():
+            return None
+        return entry
+
+    def remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.results -= len(entry.files)
+        else:
+            entry = self.empty.pop(key, None)
+        if entry is None:
+            return
+        if not entry.keys:
+            self.unkeyed.discard(key)
+        for token in entry.keys:
+            keys = self.by_token.get(token)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_token[token]
+
+    def invalidate(self, tokens: Iterable[str]):
+        """Drop the entries a file with these search tokens may match"""
+        self.generation += 1
+        tokens = set(tokens)
+        stale = set(self.unkeyed)
+        for token in tokens:
+            for key in self.by_token.get(token, ()):
+                entry = self.entries.get(key) or self.empty.get(key)
+                if all(k in tokens for k in entry.keys):
+                    stale.add(key)
+        for key in stale:
+            self.remove(key)
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.empty.clear()
+        self.by_token.clear()
+        self.unkeyed.clear()
+        self.results = 0
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.empty_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'results': self.results,
+            'empty_entries': len(self.empty),
+            'hits': self.hits,
+            'empty_hits': self.empty_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.hits + self.empty_hits) / lookups, 4) if lookups else 0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+# Initialize the cache and filter singletons
+search_cache = SearchCache(SEARCH_CACHE_RESULTS, SEARCH_NEGATIVE_CACHE_SIZE, SEARCH_CACHE_TTL)
+token_filter = TokenFilter(SEARCH_BLOOM_CAPACITY)
@@ -389,17 +389,40 @@ class SqlAdapter:
             session.commit()
             return True
     
-    def get_search_results(self, query, max_results=10, offset=0):
-        """Get search results for a query"""
+    def get_search_results(self, query, max_results=10, offset=0, tag=None):
+        """Get search results for a query, optionally only files whose name contains tag"""
         with self.Session() as session:
             # SQL LIKE search with case insensitivity
             search_pattern = f"%{query}%"
-            results = session.query(Media).filter(
-                Media.file_name.ilike(search_pattern)
-            ).offset(offset).limit(max_results).all()
+            results = session.query(Media).filter(Media.file_name.ilike(search_pattern))
+            if tag:
+                results = results.filter(Media.file_name.ilike(f"%{tag}%"))
+            results = results.offset(offset).limit(max_results).all()
             
             return [media.to_dict() for media in results]
     
+    def count_search_results(self, query, limit=None, tag=None):
+        """Count the files matching a query, stopping at limit"""
+        with self.Session() as session:
+            search_pattern = f"%{query}%"
+            matches = session.query(Media.id).filter(Media.file_name.ilike(search_pattern))
+            if tag:
+                matches = matches.filter(Media.file_name.ilike(f"%{tag}%"))
+            if limit:
+                matches = matches.limit(limit)
+            return matches.count()
+    
+    def count_tags(self, query, tags):
+        """Count the files matching a query whose name contains each tag, in one scan"""
+        if not tags:
+            return {}
+        with self.Session() as session:
+            search_pattern = f"%{query}%"
+            counts = session.query(*[
+                func.count(Media.id).filter(Media.file_name.ilike(f"%{tag}%")) for tag in tags
+            ]).filter(Media.file_name.ilike(search_pattern)).one()
+            return dict(zip(tags, counts))
+    
     def delete_files(self, query):
         """Delete files matching a query"""
         with self.Session() as session:
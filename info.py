@@ -33,6 +33,7 @@ BOT_TOKEN = environ.get('BOT_TOKEN', '')
 if len(BOT_TOKEN) == 0:
     print('Error - BOT_TOKEN is missing, exiting now')
     exit()
+MULTI_TOKENS = environ.get('MULTI_TOKENS', '').split() # Extra bot tokens used only to stream files, separated by space
 PORT = int(environ.get('PORT', '80'))
 
 # Add your images to "imgs" folder in this repo (https://github.com/HA-Bots/Auto-Filter-Bot/tree/main/imgs)
@@ -117,6 +118,12 @@ else:
             print('Info - Additional MongoDB URL configured via MULTI_MONGODB_URLS')
         else:
             print('Warning - MULTI_MONGODB_URLS is not a valid JSON array or MongoDB URL')
+# Stable names of the MongoDB instances used to route files, one per instance in the order
+# DATABASE_URL, SECOND_DATABASE_URL, MULTI_MONGODB_URLS. Instances without one are named db1, db2...
+MONGODB_SHARD_NAMES = environ.get('MONGODB_SHARD_NAMES', '').split()
+# Also look for duplicates on the instances that aren't a file's home, where files saved before
+# routing live. Turn off once they have been moved to their home instances.
+SHARD_LEGACY_DUP_CHECK = is_enabled('SHARD_LEGACY_DUP_CHECK', True)
 
 DATABASE_NAME = environ.get('DATABASE_NAME', "Cluster0")
 COLLECTION_NAME = environ.get('COLLECTION_NAME', 'Files')
@@ -134,6 +141,13 @@ DELETE_TIME = int(environ.get('DELETE_TIME', 300)) # Add time in seconds
 CACHE_TIME = int(environ.get('CACHE_TIME', 300))
 MAX_BTN = int(environ.get('MAX_BTN', 5))
 MAX_BUTTONS = MAX_BTN
+SEARCH_COUNT_LIMIT = int(environ.get('SEARCH_COUNT_LIMIT', 1000)) # Stop counting search results after this many matches
+SEARCH_SHARD_TIMEOUT = float(environ.get('SEARCH_SHARD_TIMEOUT', 5)) # Skip a MongoDB instance that takes longer than this (seconds)
+SEARCH_CACHE_RESULTS = int(environ.get('SEARCH_CACHE_RESULTS', 50000)) # Files kept in memory across all cached searches, 0 disables the cache
+SEARCH_CACHE_TTL = int(environ.get('SEARCH_CACHE_TTL', 1800)) # Seconds a cached search result is kept
+SEARCH_NEGATIVE_CACHE_SIZE = int(environ.get('SEARCH_NEGATIVE_CACHE_SIZE', 5000)) # Queries without results kept in memory, 0 disables them
+SEARCH_BLOOM_CAPACITY = int(environ.get('SEARCH_BLOOM_CAPACITY', 5000000)) # Distinct search tokens the token bloom filter is sized for
+CHATTER_MAX_WORDS = int(environ.get('CHATTER_MAX_WORDS', 10)) # Group messages with more words are not searched
 LANGUAGES = [language.lower() for language in environ.get('LANGUAGES', 'hindi english telugu tamil kannada malayalam marathi punjabi').split()]
 QUALITY = [quality.lower() for quality in environ.get('QUALITY', '360p 480p 720p 1080p 2160p').split()]
 IMDB_TEMPLATE = environ.get("IMDB_TEMPLATE", script.IMDB_TEMPLATE)
@@ -143,6 +157,9 @@ SHORTLINK_API = environ.get("SHORTLINK_API", "")
 VERIFY_EXPIRE = int(environ.get('VERIFY_EXPIRE', 0)) # Add time in seconds
 WELCOME_TEXT = environ.get("WELCOME_TEXT", script.WELCOME_TEXT)
 INDEX_EXTENSIONS = [extensions.lower() for extensions in environ.get('INDEX_EXTENSIONS', 'mp4 mkv').split()]
+INDEX_BATCH_SIZE = int(environ.get('INDEX_BATCH_SIZE', 200)) # Files written per bulk insert while indexing
+INDEX_CONCURRENCY = int(environ.get('INDEX_CONCURRENCY', 3)) # Channels indexed at the same time
+INDEX_RATE_LIMIT = float(environ.get('INDEX_RATE_LIMIT', 20)) # Telegram API calls per second shared by all indexing jobs
 PM_FILE_DELETE_TIME = int(environ.get('PM_FILE_DELETE_TIME', '300'))
 
 # boolean settings
@@ -154,6 +171,7 @@ PROTECT_CONTENT = is_enabled('PROTECT_CONTENT', False)
 LONG_IMDB_DESCRIPTION = is_enabled("LONG_IMDB_DESCRIPTION", False)
 LINK_MODE = is_enabled("LINK_MODE", True)
 AUTO_FILTER = is_enabled('AUTO_FILTER', True)
+CHATTER_FILTER = is_enabled('CHATTER_FILTER', True) # Skip the search for group messages that are not queries
 IMDB = is_enabled('IMDB', False)
 SPELL_CHECK = is_enabled("SPELL_CHECK", True)
 SHORTLINK = is_enabled('SHORTLINK', False)
@@ -180,6 +198,22 @@ else:
     else:
         print('Error - URL is not valid, exiting now')
         exit()
+STREAM_CACHE_SIZE = int(environ.get('STREAM_CACHE_SIZE', 1024)) # File properties kept in memory for streaming
+STREAM_CACHE_TTL = int(environ.get('STREAM_CACHE_TTL', 6 * 60 * 60)) # Seconds before cached file properties are looked up again, expired file references are refreshed on their own
+STREAM_PREFETCH = int(environ.get('STREAM_PREFETCH', 4)) # Chunks requested ahead of the one being sent while streaming
+STREAM_DISK_CACHE_SIZE = int(environ.get('STREAM_DISK_CACHE_SIZE', 0)) # Megabytes of streamed chunks cached on disk, 0 to disable
+STREAM_DISK_CACHE_DIR = environ.get('STREAM_DISK_CACHE_DIR', 'stream_cache')
+STREAM_CHUNK_LINGER = float(environ.get('STREAM_CHUNK_LINGER', 5)) # Seconds a fetched chunk stays in memory for viewers of the same file
+MEDIA_SESSION_PING_INTERVAL = int(environ.get('MEDIA_SESSION_PING_INTERVAL', 60)) # Seconds between health checks of the media sessions
+STREAM_SESSIONS_PER_DC = int(environ.get('STREAM_SESSIONS_PER_DC', 1)) # Media sessions a download is striped across, 1 to disable striping
+STREAM_MAX_ACTIVE = int(environ.get('STREAM_MAX_ACTIVE', 100)) # Streams served at once
+STREAM_MAX_PER_IP = int(environ.get('STREAM_MAX_PER_IP', 8)) # Streams served at once to one address
+# Reverse proxies in front of the web server whose X-Forwarded-For is trusted (1 on Heroku and Render),
+# 0 if clients connect directly. Unset, client addresses are unknown and STREAM_MAX_PER_IP is not applied
+STREAM_TRUSTED_PROXIES = int(environ['STREAM_TRUSTED_PROXIES']) if environ.get('STREAM_TRUSTED_PROXIES') else None
+STREAM_MAX_QUEUE = int(environ.get('STREAM_MAX_QUEUE', 50)) # Streams waiting for a free slot before new ones get a 503
+STREAM_QUEUE_TIMEOUT = float(environ.get('STREAM_QUEUE_TIMEOUT', 10)) # Seconds a stream waits for a free slot
+STREAM_FETCH_SLOTS = int(environ.get('STREAM_FETCH_SLOTS', 32)) # Chunk fetches from Telegram in flight across all streams
 
 #start command reactions and sticker
 REACTIONS = [reactions for reactions in environ.get('REACTIONS', '🤝 😇 🤗 😍 👍 🎅 😐 🥰 🤩 😱 🤣 😘 👏 😛 😈 🎉 ⚡️ 🫡 🤓 😎 🏆 🔥 🤭 🌚 🆒 👻 😁').split()]  # Multiple reactions can be used separated by space
@@ -1,12 +1,16 @@
 
 import logging
-import math
 import mimetypes
 import secrets
 from aiohttp import web
 from info import BIN_CHANNEL
 from utils import temp
-from web.utils.custom_dl import TGCustomYield
+from web.utils.custom_dl import get_streamer
+from web.utils.client_pool import get_client, track_workload
+from web.utils.file_properties import FileNotFound
+from web.utils.http_range import send_stream_response
+from web.utils.chunk_planner import access_tracker
+from web.utils.stream_scheduler import get_viewer_key
 from web.utils.render_template import media_watch, render_page
 
 # Define routes object if not already defined
@@ -763,23 +767,8 @@ async def download_handler(request):
         return web.Response(text=error_html, content_type='text/html')
 
 
-async def chunk_size(length):
-    """Calculate chunk size for efficient streaming"""
-    if length > 104857600:  # 100 MB
-        return 1048576  # 1 MB
-    if length > 10485760:  # 10 MB
-        return 524288  # 512 KB
-    return 262144  # 256 KB
-
-async def offset_fix(offset, chunk_size):
-    """Calculate offset for chunks"""
-    offset -= offset % chunk_size
-    return offset
-
 async def media_download(request, message_id: int):
     try:
-        range_header = request.headers.get('Range', 0)
-        
         # Safely get the message
         if not temp.BOT:
             return web.Response(
@@ -787,96 +776,40 @@ async def media_download(request, message_id: int):
                 text="Bot service unavailable",
                 content_type="text/plain"
             )
-            
+
+        # Safely get file properties, cached by the streamer across requests
+        client_index, client = get_client()
+        streamer = get_streamer(client)
         try:
-            media_msg = await temp.BOT.get_messages(BIN_CHANNEL, message_id)
-            if not media_msg:
-                return web.Response(
-                    status=404, 
-                    text="File not found", 
-                    content_type="text/plain"
-                )
-        except Exception as e:
+            file_properties = await streamer.get_file_properties(message_id)
+        except FileNotFound as e:
             print(f"Error retrieving message: {str(e)}")
             return web.Response(
                 status=404, 
                 text="File not found or access denied", 
                 content_type="text/plain"
             )
-            
-        # Safely get file properties
-        try:
-            file_properties = await TGCustomYield().generate_file_properties(media_msg)
-            if not file_properties:
-                return web.Response(
-                    status=500, 
-                    text="Could not process file properties", 
-                    content_type="text/plain"
-                )
-            file_size = file_properties.file_size
-        except Exception as e:
-            print(f"Error generating file properties: {str(e)}")
+        if not file_properties.file_size:
             return web.Response(
                 status=500, 
-                text="Failed to process file", 
+                text="Could not process file properties", 
                 content_type="text/plain"
             )
 
-        # Process range headers
-        try:
-            if range_header:
-                from_bytes, until_bytes = range_header.replace('bytes=', '').split('-')
-                from_bytes = int(from_bytes)
-                until_bytes = int(until_bytes) if until_bytes else file_size - 1
-            else:
-                from_bytes = request.http_range.start or 0
-                until_bytes = request.http_range.stop or file_size - 1
-
-            # Validate range
-            if from_bytes < 0 or until_bytes >= file_size or from_bytes > until_bytes:
-                return web.Response(
-                    status=416,  # Range Not Satisfiable
-                    text=f"Invalid range. File size: {file_size}",
-                    content_type="text/plain"
-                )
-                
-            req_length = until_bytes - from_bytes
-        except Exception as e:
-            print(f"Error processing range headers: {str(e)}")
-            from_bytes = 0
-            until_bytes = file_size - 1
-            req_length = until_bytes - from_bytes
-
         # Process file and prepare response
         try:
-            new_chunk_size = await chunk_size(req_length)
-            offset = await offset_fix(from_bytes, new_chunk_size)
-            first_part_cut = from_bytes - offset
-            last_part_cut = (until_bytes % new_chunk_size) + 1
-            part_count = math.ceil(req_length / new_chunk_size)
-            body = TGCustomYield().yield_file(media_msg, offset, first_part_cut, last_part_cut, part_count,
-                                          new_chunk_size)
+            def yield_range(first, last, transfer):
+                # Seeks start with small requests, sequential reads with large ones
+                start_size = access_tracker.get_start_size(get_viewer_key(request), file_properties.media_id, first, last)
+                return track_workload(client_index, streamer.yield_range(file_properties, first, last, start_size, get_viewer_key(request), transfer))
 
             file_name = file_properties.file_name if file_properties.file_name \
                 else f"{secrets.token_hex(2)}.jpeg"
             mime_type = file_properties.mime_type if file_properties.mime_type \
-                else f"{mimetypes.guess_type(file_name)}"
-
-            return_resp = web.Response(
-                status=206 if range_header else 200,
-                body=body,
-                headers={
-                    "Content-Type": mime_type,
-                    "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-                    "Content-Disposition": f'attachment; filename="{file_name}"',
-                    "Accept-Ranges": "bytes",
-                }
-            )
-
-            if return_resp.status == 200:
-                return_resp.headers.add("Content-Length", str(file_size))
+                else (mimetypes.guess_type(file_name)[0] or "application/octet-stream")
 
-            return return_resp
+            # Ranges, conditional requests and HEAD are handled by the shared layer
+            return await send_stream_response(request, file_properties, yield_range, mime_type, file_name)
             
         except Exception as e:
             print(f"Error preparing file download: {str(e)}")
@@ -0,0 +1,91 @@
+import re
+from pyrogram import Client, filters
+from info import ADMINS, CHATTER_FILTER, CHATTER_MAX_WORDS
+from utils import temp
+from database.ia_filterdb import tokenize, MIN_PREFIX_LEN, MAX_PREFIX_LEN
+from database.search_cache import token_filter
+
+class ChatterFilter:
+    """Class to tell group chatter from search queries before searching"""
+
+    def __init__(self, enabled, max_words):
+        """Initialize the filter"""
+        self.enabled = enabled
+        self.max_words = max_words
+        self.link_pattern = re.compile(r'https?://\S+|www\.\S+|t\.me/\S+')
+        # Messages made only of these words are small talk. Words that can be a
+        # title on their own, like hello, you or welcome, are left out.
+        self.chatter_words = {
+            'hii', 'hiii', 'helo', 'heyy', 'hlo', 'sup', 'okk', 'kk',
+            'thanku', 'thankyou', 'thx', 'tq', 'ty', 'bruh', 'gm', 'gn',
+            'lol', 'lmao', 'haha', 'hahaha', 'hmm', 'hm', 'pls', 'plz',
+        }
+        # Per group counters of checked and skipped messages, with the reasons
+        self.stats = {}
+
+    def get_reason(self, message):
+        """Return why a group message is not a search query, or None if it may be one"""
+        text = message.text or ''
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.id != temp.ME:
+            # Talking to another member, not asking the bot
+            return 'reply'
+        if self.link_pattern.search(text):
+            return 'link'
+        words = tokenize(text)
+        if not words:
+            # Emoji, stickers as text and punctuation
+            return 'no_words'
+        keys = [word[:MAX_PREFIX_LEN] for word in words if len(word) >= MIN_PREFIX_LEN]
+        # Once the filter holds the catalog, a message with no word of any indexed title
+        # can't find a file. Before that every message may be a title.
+        unknown = token_filter.ready and not any(key in token_filter for key in keys)
+        if all(word in self.chatter_words for word in words) and (unknown or not token_filter.ready):
+            return 'greeting'
+        if len(words) > self.max_words:
+            return 'too_long'
+        if unknown and keys and len(words) >= 3:
+            # Too long to be a typo
+            return 'unknown_words'
+        return None
+
+    def should_skip(self, message):
+        """Count a group message and return True if it should not be searched"""
+        if not self.enabled:
+            return False
+        stats = self.stats.setdefault(message.chat.id, {'checked': 0, 'skipped': 0, 'reasons': {}})
+        stats['checked'] += 1
+        reason = self.get_reason(message)
+        if reason is None:
+            return False
+        stats['skipped'] += 1
+        stats['reasons'][reason] = stats['reasons'].get(reason, 0) + 1
+        return True
+
+    def get_stats(self):
+        """Return the totals and the per group counters"""
+        checked = sum(stats['checked'] for stats in self.stats.values())
+        skipped = sum(stats['skipped'] for stats in self.stats.values())
+        return {
+            'enabled': self.enabled,
+            'checked': checked,
+            'skipped': skipped,
+            'skip_rate': round(skipped / checked, 4) if checked else 0,
+            'groups': self.stats,
+        }
+
+# Create a singleton instance
+chatter_filter = ChatterFilter(CHATTER_FILTER, CHATTER_MAX_WORDS)
+
+@Client.on_message(filters.command('chatter_stats') & filters.user(ADMINS))
+async def chatter_stats(bot, message):
+    stats = chatter_filter.get_stats()
+    text = f"<b>Chatter filter</b> ({'on' if stats['enabled'] else 'off'})"
+    text += f"\nChecked: <code>{stats['checked']}</code> | Skipped: <code>{stats['skipped']}</code> | Rate: <code>{stats['skip_rate']:.1%}</code>"
+    groups = sorted(stats['groups'].items(), key=lambda item: item[1]['skipped'], reverse=True)
+    for chat_id, group in groups[:15]:
+        reasons = ', '.join(f"{reason} {count}" for reason, count in sorted(group['reasons'].items(), key=lambda item: -item[1]))
+        text += f"\n\n<code>{chat_id}</code> - <code>{group['skipped']}/{group['checked']}</code> skipped"
+        if reasons:
+            text += f"\n{reasons}"
+    await message.reply(text)
@@ -9,6 +9,7 @@ from pyrogram import Client, filters, enums
 from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from database.ia_filterdb import Media, get_file_details, delete_files
 from database.users_chats_db import db
+from database.search_cache import search_cache, token_filter
 from info import SECOND_DATABASE_URL, TIME_ZONE, FORCE_SUB_CHANNELS, STICKERS, INDEX_CHANNELS, ADMINS, IS_VERIFY, VERIFY_TUTORIAL, VERIFY_EXPIRE, SHORTLINK_API, SHORTLINK_URL, DELETE_TIME, SUPPORT_LINK, UPDATES_LINK, LOG_CHANNEL, PICS, IS_STREAM, REACTIONS, PM_FILE_DELETE_TIME
 from utils import get_settings, get_size, is_subscribed, is_check_admin, get_shortlink, get_verify_status, update_verify_status, save_group_settings, temp, get_readable_time, get_wish, get_seconds
 from git import Repo
@@ -391,6 +392,20 @@ async def stats(bot, message):
     uptime = get_readable_time(time_now() - temp.START_TIME)
     await message.reply_text(script.STATUS_TXT.format(files, users, chats, used_size, free_size, secnd_used_size, secnd_free_size, uptime))    
 
+@Client.on_message(filters.command('search_stats') & filters.user(ADMINS))
+async def search_stats(bot, message):
+    stats = search_cache.get_stats()
+    text = '<b>Search cache</b>'
+    text += f"\nEntries: <code>{stats['entries']}</code> | Files held: <code>{stats['results']}</code>"
+    text += f"\nHits: <code>{stats['hits']}</code> | Misses: <code>{stats['misses']}</code> | Hit ratio: <code>{stats['hit_ratio']:.1%}</code>"
+    text += f"\nEvictions: <code>{stats['evictions']}</code> | Invalidations: <code>{stats['invalidations']}</code>"
+    text += f"\nEmpty results: <code>{stats['empty_entries']}</code> cached, <code>{stats['empty_hits']}</code> hits"
+    stats = token_filter.get_stats()
+    text += '\n\n<b>Token filter</b>'
+    text += f"\nReady: <code>{stats['ready']}</code> | Tokens: <code>{stats['tokens']}</code> | Size: <code>{get_size(stats['size_bytes'])}</code>"
+    text += f"\nQueries rejected: <code>{stats['rejected']}</code>"
+    await message.reply(text)
+
 @Client.on_message(filters.command('settings'))
 async def settings(client, message):
     userid = message.from_user.id if message.from_user else None
@@ -1,35 +1,165 @@
-import re
 import time
 import asyncio
 from pyrogram import Client, filters, enums
 from pyrogram.errors import FloodWait
-from info import ADMINS, INDEX_EXTENSIONS
-from database.ia_filterdb import save_file
+from info import ADMINS, INDEX_EXTENSIONS, INDEX_BATCH_SIZE, INDEX_CONCURRENCY, INDEX_RATE_LIMIT
+from database.ia_filterdb import get_media_fields, save_files, backfill_index_fields, backfill_lock, load_token_filter, using_postgres
+from database.index_checkpoints import index_checkpoints
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from utils import temp, get_readable_time
 
-lock = asyncio.Lock()
+class RateBudget:
+    """Token bucket shared by every indexing job for its Telegram API calls"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = asyncio.Lock()
+
+    @property
+    def throttled(self):
+        return time.monotonic() < self.paused_until
+
+    def pause(self, seconds):
+        """Stop every job after a FloodWait"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+# Jobs run INDEX_CONCURRENCY at a time and share one rate budget so that
+# indexing several channels together doesn't trip FloodWait
+index_slots = asyncio.Semaphore(INDEX_CONCURRENCY)
+rate_budget = RateBudget(INDEX_RATE_LIMIT)
+
+
+async def call_api(job, func, *args, **kwargs):
+    """Call a Telegram API method within the shared rate budget"""
+    def set_status(status):
+        if job['status'] in ('running', 'throttled'):
+            job['status'] = status
+
+    while True:
+        if rate_budget.throttled:
+            set_status('throttled')
+        await rate_budget.acquire()
+        set_status('running')
+        try:
+            return await func(*args, **kwargs)
+        except FloodWait as e:
+            set_status('throttled')
+            rate_budget.pause(e.value)
+
+
+def get_active_job(chat):
+    job = temp.INDEX_JOBS.get(str(chat))
+    if job and job['status'] in ('queued', 'running', 'throttled'):
+        return job
+    return None
+
+def create_job(chat, lst_msg_id, skip):
+    """
+    Register a queued job for a channel, or return None if one is already active.
+    Nothing is awaited between the check and the registration, so two quick
+    confirmations can't both start a job. The task running it is kept in
+    job['task'], so it isn't garbage collected while it runs.
+    """
+    if get_active_job(chat):
+        return None
+    stats = dict(total_files=0, duplicate=0, errors=0, deleted=0, no_media=0, unsupported=0, badfiles=0, current=skip)
+    job = dict(chat=chat, status='queued', cancel=False, last_msg_id=lst_msg_id, stats=stats, queued_at=time.time(), started_at=None, finished_at=None, task=None)
+    temp.INDEX_JOBS[str(chat)] = job
+    return job
 
 @Client.on_callback_query(filters.regex(r'^index'))
 async def index_files(bot, query):
     _, ident, chat, lst_msg_id, skip = query.data.split("#")
     if ident == 'yes':
         msg = query.message
+        try:
+            chat = int(chat)
+        except:
+            chat = chat
+        job = create_job(chat, int(lst_msg_id), int(skip))
+        if not job:
+            return await msg.edit("This channel is already being indexed.")
         await msg.edit("Starting Indexing...")
+        job['task'] = asyncio.create_task(index_files_to_db(job, msg, bot, int(skip)))
+    elif ident == 'resume':
+        msg = query.message
         try:
             chat = int(chat)
         except:
             chat = chat
-        await index_files_to_db(int(lst_msg_id), chat, msg, bot, int(skip))
+        job = create_job(chat, int(lst_msg_id), 0)
+        if not job:
+            return await msg.edit("This channel is already being indexed.")
+        try:
+            checkpoint = await index_checkpoints.get_checkpoint(chat)
+        except Exception:
+            checkpoint = None
+        if not checkpoint:
+            # Release the channel for a new index
+            del temp.INDEX_JOBS[str(chat)]
+            return await msg.edit("No checkpoint found for this channel, start a new index.")
+        job['stats'].update(checkpoint['stats'])
+        await msg.edit(f"Resuming Indexing from message <code>{checkpoint['position']}</code>...")
+        job['task'] = asyncio.create_task(index_files_to_db(job, msg, bot, checkpoint['position'] + 1))
     elif ident == 'cancel':
-        temp.CANCEL = True
+        try:
+            chat = int(chat)
+        except:
+            chat = chat
+        job = get_active_job(chat)
+        if job and job['status'] == 'queued' and job['task']:
+            # Still waiting for a slot, there is nothing to save
+            job['task'].cancel()
+            job.update(status='cancelled', finished_at=time.time())
+            return await query.message.edit("Indexing cancelled before it started.")
+        if job:
+            job['cancel'] = True
         await query.message.edit("Trying to cancel Indexing...")
 
 
+@Client.on_message(filters.command('index_status') & filters.user(ADMINS))
+async def index_status(bot, message):
+    if not temp.INDEX_JOBS:
+        return await message.reply('No indexing jobs yet.')
+    text = '<b>Indexing jobs</b>'
+    for job in temp.INDEX_JOBS.values():
+        text += f"\n\n<code>{job['chat']}</code> - <code>{job['status']}</code>\nSaved: <code>{job['stats']['total_files']}</code> | Duplicates: <code>{job['stats']['duplicate']}</code> | Messages: <code>{job['stats']['current']}/{job['last_msg_id']}</code>"
+    await message.reply(text)
+
+
+@Client.on_message(filters.command('backfill') & filters.user(ADMINS))
+async def backfill(bot, message):
+    if using_postgres:
+        return await message.reply('Search fields are only stored with MongoDB.')
+    if backfill_lock.locked():
+        return await message.reply('A backfill is already running.')
+    msg = await message.reply('Computing the search fields of files saved by older versions...')
+    start_time = time.time()
+    updated = await backfill_index_fields()
+    await load_token_filter()
+    await msg.edit(f'Backfilled <code>{updated}</code> files in <code>{get_readable_time(time.time() - start_time)}</code>.')
+
+
 @Client.on_message(filters.command('index') & filters.private & filters.user(ADMINS))
 async def send_for_index(bot, message):
-    if lock.locked():
-        return await message.reply('Wait until previous process complete.')
     i = await message.reply("Forward last message or send last message link.")
     msg = await bot.listen(chat_id=message.chat.id, user_id=message.from_user.id)
     await i.delete()
@@ -56,6 +186,8 @@ async def send_for_index(bot, message):
 
     if chat.type != enums.ChatType.CHANNEL:
         return await message.reply("I can index only channels.")
+    if get_active_job(chat_id):
+        return await message.reply("This channel is already being indexed, check /index_status.")
 
     s = await message.reply("Send skip message number.")
     msg = await bot.listen(chat_id=message.chat.id, user_id=message.from_user.id)
@@ -70,64 +202,153 @@ async def send_for_index(bot, message):
     ],[
         InlineKeyboardButton('CLOSE', callback_data='close_data'),
     ]]
+    text = f'Do you want to index {chat.title} channel?\nTotal Messages: <code>{last_msg_id}</code>'
+    checkpoint = await index_checkpoints.get_checkpoint(chat_id)
+    if checkpoint and checkpoint['position'] < last_msg_id:
+        buttons.insert(1, [
+            InlineKeyboardButton('RESUME', callback_data=f'index#resume#{chat_id}#{last_msg_id}#{skip}')
+        ])
+        text += f'\n\nAn interrupted index stopped at message <code>{checkpoint["position"]}</code>, press RESUME to continue from there.'
     reply_markup = InlineKeyboardMarkup(buttons)
-    await message.reply(f'Do you want to index {chat.title} channel?\nTotal Messages: <code>{last_msg_id}</code>', reply_markup=reply_markup)
+    await message.reply(text, reply_markup=reply_markup)
 
 
-async def index_files_to_db(lst_msg_id, chat, msg, bot, skip):
-    start_time = time.time()
-    total_files = 0
-    duplicate = 0
-    errors = 0
-    deleted = 0
-    no_media = 0
-    unsupported = 0
-    badfiles = 0
-    current = skip
-    
-    async with lock:
-        try:
-            async for message in bot.iter_messages(chat, lst_msg_id, skip):
-                time_taken = get_readable_time(time.time()-start_time)
-                if temp.CANCEL:
-                    temp.CANCEL = False
-                    await msg.edit(f"Successfully Cancelled!\nCompleted in {time_taken}\n\nSaved <code>{total_files}</code> files to Database!\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>\nUnsupported Media: <code>{unsupported}</code>\nErrors Occurred: <code>{errors}</code>\nBad Files Ignoref: <code>{badfiles}</code>")
-                    return
-                current += 1
-                if current % 30 == 0:
-                    btn = [[
-                        InlineKeyboardButton('CANCEL', callback_data=f'index#cancel#{chat}#{lst_msg_id}#{skip}')
-                    ]]
-                    try:
-                        await msg.edit_text(text=f"Total messages received: <code>{current}</code>\nTotal messages saved: <code>{total_files}</code>\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>\nUnsupported Media: <code>{unsupported}</code>\nErrors Occurred: <code>{errors}</code>\nBad Files Ignoref: <code>{badfiles}</code>", reply_markup=InlineKeyboardMarkup(btn))
-                    except FloodWait as e:
-                        await asyncio.sleep(e.value)
+def get_status_text(stats):
+    return f"Total messages received: <code>{stats['current']}</code>\nTotal messages saved: <code>{stats['total_files']}</code>\nDuplicate Files Skipped: <code>{stats['duplicate']}</code>\nDeleted Messages Skipped: <code>{stats['deleted']}</code>\nNon-Media messages skipped: <code>{stats['no_media'] + stats['unsupported']}</code>\nUnsupported Media: <code>{stats['unsupported']}</code>\nErrors Occurred: <code>{stats['errors']}</code>\nBad Files Ignoref: <code>{stats['badfiles']}</code>"
+
+
+async def index_files_to_db(job, msg, bot, skip):
+    """
+    Index a channel through a three stage pipeline running concurrently:
+    fetching message batches, turning media into database fields, and
+    writing those fields with bulk inserts of INDEX_BATCH_SIZE files.
+
+    The last message id whose files are written is checkpointed every few
+    seconds, so an interrupted job can be resumed from its checkpoint stats.
+    Jobs wait in the queue until one of the INDEX_CONCURRENCY slots frees up.
+    """
+    chat, lst_msg_id, stats = job['chat'], job['last_msg_id'], job['stats']
+    # Last message id whose files are all written to the database, with the
+    # counters as they were at that message
+    checkpoint = dict(position=skip - 1, stats=dict(stats))
+    messages_queue = asyncio.Queue(maxsize=4)
+    files_queue = asyncio.Queue(maxsize=4)
+
+    async def fetch_messages():
+        current = skip
+        while not job['cancel']:
+            new_diff = min(200, lst_msg_id - current)
+            if new_diff <= 0:
+                break
+            messages = await call_api(job, bot.get_messages, chat, list(range(current, current+new_diff+1)))
+            await messages_queue.put((messages, current+new_diff))
+            current += len(messages)
+        await messages_queue.put(None)
+
+    async def prepare_files():
+        batch = []
+        while True:
+            item = await messages_queue.get()
+            if item is None:
+                break
+            messages, last_id = item
+            for message in messages:
+                stats['current'] += 1
                 if message.empty:
-                    deleted += 1
+                    stats['deleted'] += 1
                     continue
                 elif not message.media:
-                    no_media += 1
+                    stats['no_media'] += 1
                     continue
                 elif message.media not in [enums.MessageMediaType.VIDEO, enums.MessageMediaType.DOCUMENT]:
-                    unsupported += 1
+                    stats['unsupported'] += 1
                     continue
                 media = getattr(message, message.media.value, None)
                 if not media:
-                    unsupported += 1
+                    stats['unsupported'] += 1
                     continue
                 elif not (str(media.file_name).lower()).endswith(tuple(INDEX_EXTENSIONS)):
-                    unsupported += 1
+                    stats['unsupported'] += 1
                     continue
                 media.caption = message.caption
-                file_name = re.sub(r"@\w+|(_|\-|\.|\+)", " ", str(media.file_name))
-                sts = await save_file(media)
-                if sts == 'suc':
-                    total_files += 1
-                elif sts == 'dup':
-                    duplicate += 1
-                elif sts == 'err':
-                    errors += 1
+                try:
+                    batch.append(get_media_fields(media))
+                except Exception:
+                    stats['badfiles'] += 1
+            # Flush full batches, and empty ones so the checkpoint still
+            # advances through long runs of messages without files
+            if len(batch) >= INDEX_BATCH_SIZE or not batch:
+                await files_queue.put((batch, last_id, dict(stats)))
+                batch = []
+        if batch:
+            await files_queue.put((batch, last_id, dict(stats)))
+        await files_queue.put(None)
+
+    async def write_files():
+        while True:
+            item = await files_queue.get()
+            if item is None:
+                break
+            batch, last_id, counters = item
+            if batch:
+                saved, duplicate, errors = await save_files(batch)
+                stats['total_files'] += saved
+                stats['duplicate'] += duplicate
+                stats['errors'] += errors
+            for key in ('total_files', 'duplicate', 'errors'):
+                counters[key] = stats[key]
+            checkpoint.update(position=last_id, stats=counters)
+
+    async def report_progress():
+        btn = [[
+            InlineKeyboardButton('CANCEL', callback_data=f'index#cancel#{chat}#{lst_msg_id}#{skip}')
+        ]]
+        while True:
+            try:
+                await asyncio.wait_for(finished.wait(), 10)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await index_checkpoints.save_checkpoint(chat, checkpoint['position'], checkpoint['stats'])
+            try:
+                await call_api(job, msg.edit_text, text=get_status_text(stats), reply_markup=InlineKeyboardMarkup(btn))
+            except Exception:
+                pass
+
+    async def stop_reporter():
+        # Let a report in progress finish, so it can't land after the final
+        # checkpoint or message
+        finished.set()
+        await asyncio.gather(reporter, return_exceptions=True)
+
+    if index_slots.locked():
+        await msg.edit("Indexing is queued, it starts when a running job finishes.\nCheck /index_status for progress.")
+    async with index_slots:
+        start_time = time.time()
+        job.update(status='running', started_at=start_time)
+        stages = [asyncio.create_task(stage()) for stage in (fetch_messages, prepare_files, write_files)]
+        finished = asyncio.Event()
+        reporter = asyncio.create_task(report_progress())
+        try:
+            await asyncio.gather(*stages)
         except Exception as e:
-            await msg.reply(f'Index canceled due to Error - {e}')
+            job['status'] = 'failed'
+            await stop_reporter()
+            await index_checkpoints.save_checkpoint(chat, checkpoint['position'], checkpoint['stats'])
+            await msg.reply(f'Index canceled due to Error - {e}\nUse /index again to resume from message <code>{checkpoint["position"]}</code>.')
         else:
-            await msg.edit(f'Succesfully saved <code>{total_files}</code> to Database!\nCompleted in {time_taken}\n\nDuplicate Files Skipped: <code>{duplicate}</code>\nDeleted Messages Skipped: <code>{deleted}</code>\nNon-Media messages skipped: <code>{no_media + unsupported}</code>\nUnsupported Media: <code>{unsupported}</code>\nErrors Occurred: <code>{errors}</code>\nBad Files Ignoref: <code>{badfiles}</code>')
+            time_taken = get_readable_time(time.time()-start_time)
+            await stop_reporter()
+            if job['cancel']:
+                job['status'] = 'cancelled'
+                await index_checkpoints.save_checkpoint(chat, checkpoint['position'], checkpoint['stats'])
+                await msg.edit(f"Successfully Cancelled!\nCompleted in {time_taken}\n\n{get_status_text(stats)}")
+            else:
+                job['status'] = 'done'
+                await index_checkpoints.delete_checkpoint(chat)
+                await msg.edit(f'Succesfully saved <code>{stats["total_files"]}</code> to Database!\nCompleted in {time_taken}\n\n{get_status_text(stats)}')
+        finally:
+            job['finished_at'] = time.time()
+            reporter.cancel()
+            for stage in stages:
+                stage.cancel()
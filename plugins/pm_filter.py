@@ -10,8 +10,10 @@ from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQ
 from pyrogram import Client, filters, enums
 from utils import get_size, is_subscribed, is_check_admin, get_wish, get_shortlink, get_readable_time, get_poster, temp, get_settings, save_group_settings
 from database.users_chats_db import db
-from database.ia_filterdb import Media, get_search_results, get_file_details, delete_files
+from database.ia_filterdb import Media, get_search_results, get_search_facets, get_file_details, delete_files, get_release_info
+from database.search_cache import search_cache
 from plugins.smart_preview import smart_analyzer
+from plugins.chatter_filter import chatter_filter
 from plugins.preview_wizard import preview_wizard
 
 BUTTONS = {}
@@ -212,6 +214,8 @@ async def group_search(client, message):
             await client.send_message(LOG_CHANNEL, f"#Request\n★ User: {message.from_user.mention}\n★ Group: {message.chat.title}\n\n★ Message: {re.sub(r'#request', '', message.text.lower())}")
             await message.reply_text("Request sent!")
             return  
+        elif chatter_filter.should_skip(message):
+            return
         else:
             s = await message.reply(f"<b><i>⚠️ `{message.text}` searching...</i></b>")
             await auto_filter(client, message, s)
@@ -313,10 +317,14 @@ async def languages_(client: Client, query: CallbackQuery):
     _, key, req, offset = query.data.split("#")
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
+    search = BUTTONS.get(key)
+    counts = (await get_search_facets(search))['languages'] if search else {}
+    # Only offer the languages the results have, with their counts
+    languages = [lang for lang in LANGUAGES if counts.get(lang)] or LANGUAGES
     btn = [
-        [InlineKeyboardButton(text=LANGUAGES[i].title(), callback_data=f"lang_search#{LANGUAGES[i]}#{key}#{offset}#{req}"),
-         InlineKeyboardButton(text=LANGUAGES[i+1].title(), callback_data=f"lang_search#{LANGUAGES[i+1]}#{key}#{offset}#{req}")]
-        for i in range(0, len(LANGUAGES)-1, 2)
+        [InlineKeyboardButton(text=f"{lang.title()} ({counts[lang]})" if counts.get(lang) else lang.title(), callback_data=f"lang_search#{lang}#{key}#{offset}#{req}")
+         for lang in languages[i:i+2]]
+        for i in range(0, len(languages), 2)
     ]
     btn.append([InlineKeyboardButton(text="🔙 Back to Main Page", callback_data=f"next_{req}_{key}_{offset}")])  
     await query.message.edit_text("<b>🌐 Select Your Preferred Language</b>", disable_web_page_preview=True, reply_markup=InlineKeyboardMarkup(btn))
@@ -326,10 +334,14 @@ async def quality(client: Client, query: CallbackQuery):
     _, key, req, offset = query.data.split("#")
     if int(req) != query.from_user.id:
         return await query.answer(f"Hello {query.from_user.first_name},\nDon't Click Other Results!", show_alert=True)
+    search = BUTTONS.get(key)
+    counts = (await get_search_facets(search))['qualities'] if search else {}
+    # Only offer the qualities the results have, with their counts
+    qualities = [qual for qual in QUALITY if counts.get(qual)] or QUALITY
     btn = [
-        [InlineKeyboardButton(text=QUALITY[i].title(), callback_data=f"qual_search#{QUALITY[i]}#{key}#{offset}#{req}"),
-         InlineKeyboardButton(text=QUALITY[i+1].title(), callback_data=f"qual_search#{QUALITY[i+1]}#{key}#{offset}#{req}")]
-        for i in range(0, len(QUALITY)-1, 2)
+        [InlineKeyboardButton(text=f"{qual.title()} ({counts[qual]})" if counts.get(qual) else qual.title(), callback_data=f"qual_search#{qual}#{key}#{offset}#{req}")
+         for qual in qualities[i:i+2]]
+        for i in range(0, len(qualities), 2)
     ]
     btn.append([InlineKeyboardButton(text="🔙 Back to Main Page", callback_data=f"next_{req}_{key}_{offset}")])  
     await query.message.edit_text("<b>🎞️ Select Your Preferred Quality</b>", disable_web_page_preview=True, reply_markup=InlineKeyboardMarkup(btn))
@@ -615,7 +627,7 @@ async def smart_preview_callback(client: Client, query: CallbackQuery):
                 search_query = query.message.text.split("results for:")[1].split("\n")[0].strip() if "results for:" in query.message.text else file.file_name
 
                 # Generate metadata and preview
-                enhanced_metadata = await smart_analyzer.get_enhanced_metadata(search_query, file.file_name)
+                enhanced_metadata = await smart_analyzer.get_enhanced_metadata(search_query, file.file_name, get_release_info(file))
                 smart_preview_text = smart_analyzer.generate_smart_preview(enhanced_metadata)
 
                 # Store for future use
@@ -1009,16 +1021,14 @@ async def cb_handler(client: Client, query: CallbackQuery):
         files = await Media.count_documents()
         await query.answer('Deleting...')
         await Media.collection.drop()
+        search_cache.clear()
         await query.message.edit_text(f"Successfully deleted {files} files")
 
     elif query.data.startswith("delete"):
         _, query_ = query.data.split("_", 1)
-        deleted = 0
         await query.message.edit('Deleting...')
-        total, files = await delete_files(query_)
-        async for file in files:
-            await Media.collection.delete_one({'_id': file.file_id})
-            deleted += 1
+        # delete_files drops the cached searches the files were part of
+        deleted, files = await delete_files(query_)
         await query.message.edit(f'Deleted {deleted} files in your database in your query {query_}')
 
     elif query.data.startswith("send_all"):
@@ -1230,7 +1240,7 @@ async def auto_filter(client, msg, s, spoll=False):
     if settings.get("smart_preview", True) and imdb:
         try:
             # Generate enhanced metadata with our smart analyzer
-            enhanced_metadata = await smart_analyzer.get_enhanced_metadata(search, first_file.file_name)
+            enhanced_metadata = await smart_analyzer.get_enhanced_metadata(search, first_file.file_name, get_release_info(first_file))
             # Generate smart preview text
             smart_preview_text = smart_analyzer.generate_smart_preview(enhanced_metadata)
             # Store smart preview for use in callback
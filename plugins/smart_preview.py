@@ -3,6 +3,7 @@ import json
 from datetime import datetime
 from utils import get_poster
 from info import ADMINS, LONG_IMDB_DESCRIPTION
+from database.ia_filterdb import get_release_fields
 import logging
 
 logger = logging.getLogger(__name__)
@@ -21,16 +22,23 @@ class SmartContentAnalyzer:
             "quality": r'\b(AAC|AAC2|DD5\.1|AC3|DOLBY|ATMOS|DTS)\b',
         }
     
-    def extract_features_from_filename(self, filename):
-        """Extract features from the filename"""
+    def extract_features_from_filename(self, filename, release=None):
+        """Extract features from the filename, using the release fields stored at index time if given"""
         features = {}
         
         # Convert to uppercase for case-insensitive matching
         upper_filename = filename.upper()
         
-        # Extract each feature type
-        for feature_type, pattern in self.title_patterns.items():
-            matches = re.findall(pattern, upper_filename, re.IGNORECASE)
+        # Files indexed by older versions have no stored release fields yet
+        if release is None:
+            release = get_release_fields(filename)
+        for feature_type in ('year', 'resolution', 'source', 'codec'):
+            if release.get(feature_type):
+                features[feature_type] = str(release[feature_type])
+        
+        # Extract the feature types that are not stored
+        for feature_type in ('language', 'quality'):
+            matches = re.findall(self.title_patterns[feature_type], upper_filename, re.IGNORECASE)
             if matches:
                 features[feature_type] = matches[0]
         
@@ -51,19 +59,18 @@ class SmartContentAnalyzer:
             features['base_name'] = clean_title
         
         # Check for TV Series pattern (SxxExx)
-        series_match = re.search(r'S(\d{1,2})E(\d{1,2})', filename, re.IGNORECASE)
-        if series_match:
+        if release.get('season') is not None:
             features['content_type'] = 'TV Series'
-            features['season'] = int(series_match.group(1))
-            features['episode'] = int(series_match.group(2))
+            features['season'] = release['season']
+            features['episode'] = release['episode']
         else:
             features['content_type'] = 'Movie'
         
         return features
     
-    async def get_enhanced_metadata(self, search_query, filename):
+    async def get_enhanced_metadata(self, search_query, filename, release=None):
         """Get enhanced metadata combining filename analysis and IMDb data"""
-        features = self.extract_features_from_filename(filename)
+        features = self.extract_features_from_filename(filename, release)
         
         # Get IMDb data
         imdb_data = await get_poster(search_query, file=filename)
@@ -1,15 +1,18 @@
 import re
-import math
 import logging
 import secrets
 import mimetypes
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
 from utils import temp
-from info import BIN_CHANNEL, URL
-from web.utils.custom_dl import ByteStreamer
+from info import URL
+from web.utils.custom_dl import get_streamer
+from web.utils.client_pool import get_client, track_workload
+from web.utils.http_range import send_stream_response
+from web.utils.chunk_planner import access_tracker
+from web.utils.stream_scheduler import get_viewer_key
 from web.utils.render_template import media_watch, get_error_page
-from web.utils.file_properties import get_hash
+from web.utils.file_properties import FileNotFound
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -107,8 +110,6 @@ async def stream_media_handler(request: web.Request):
 
 async def media_streamer(request: web.Request, id: int, secure_hash: str):
     try:
-        range_header = request.headers.get("Range", 0)
-        
         if not temp.BOT:
             return web.Response(
                 status=503,
@@ -116,56 +117,25 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
                 content_type="text/plain"
             )
             
-        # Get the message from BIN_CHANNEL
-        message = await temp.BOT.get_messages(BIN_CHANNEL, id)
-        if not message:
+        # Serve through the least busy client. File properties are cached by
+        # its streamer, so only the first request of a file looks it up
+        client_index, client = get_client()
+        streamer = get_streamer(client)
+        try:
+            file_id = await streamer.get_file_properties(id)
+        except FileNotFound:
             return web.Response(status=404, text="File not found")
-            
+
         # Verify hash
-        file_hash = get_hash(message)
+        file_hash = file_id.unique_id[:6]
         if file_hash != secure_hash:
             logger.warning(f"Invalid hash: expected {file_hash}, got {secure_hash}")
             return web.Response(status=403, text="Invalid hash")
-            
-        # Initialize ByteStreamer
-        streamer = ByteStreamer(temp.BOT)
-        
-        # Get file properties
-        file_id = await streamer.get_file_properties(id)
-        file_size = file_id.file_size
-        
-        # Handle range request
-        if range_header:
-            from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-            from_bytes = int(from_bytes)
-            until_bytes = int(until_bytes) if until_bytes else file_size - 1
-        else:
-            from_bytes = request.http_range.start or 0
-            until_bytes = (request.http_range.stop or file_size) - 1
-            
-        # Validate range
-        if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-            return web.Response(
-                status=416,
-                body="416: Range not satisfiable",
-                headers={"Content-Range": f"bytes */{file_size}"},
-            )
-            
-        # Calculate chunk size and offsets
-        chunk_size = 1024 * 1024  # 1MB chunks
-        until_bytes = min(until_bytes, file_size - 1)
-        
-        offset = from_bytes - (from_bytes % chunk_size)
-        first_part_cut = from_bytes - offset
-        last_part_cut = until_bytes % chunk_size + 1
-        
-        req_length = until_bytes - from_bytes + 1
-        part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-        
-        # Get file stream
-        body = streamer.yield_file(
-            file_id, offset, first_part_cut, last_part_cut, part_count, chunk_size
-        )
+
+        def yield_range(first, last, transfer):
+            # Seeks start with small requests, sequential reads with large ones
+            start_size = access_tracker.get_start_size(get_viewer_key(request), file_id.media_id, first, last)
+            return track_workload(client_index, streamer.yield_range(file_id, first, last, start_size, get_viewer_key(request), transfer))
         
         # Determine content type and filename
         mime_type = file_id.mime_type
@@ -185,17 +155,8 @@ async def media_streamer(request: web.Request, id: int, secure_hash: str):
                 mime_type = "application/octet-stream"
                 file_name = f"{secrets.token_hex(2)}.unknown"
                 
-        return web.Response(
-            status=206 if range_header else 200,
-            body=body,
-            headers={
-                "Content-Type": f"{mime_type}",
-                "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-                "Content-Length": str(req_length),
-                "Content-Disposition": f'{disposition}; filename="{file_name}"',
-                "Accept-Ranges": "bytes",
-            },
-        )
+        # Ranges, conditional requests and HEAD are handled by the shared layer
+        return await send_stream_response(request, file_id, yield_range, mime_type or "application/octet-stream", file_name, disposition)
     except Exception as e:
         logger.error(f"Error in media_streamer: {e}")
         return web.Response(status=500, text=f"Server error: {str(e)}")
\ No newline at end of file
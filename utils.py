@@ -29,6 +29,9 @@ class temp(object):
     BOT = None
     PREMIUM = {}
     SMART_PREVIEWS = {}
+    INDEX_JOBS = {}
+    MULTI_CLIENTS = {}
+    WORK_LOADS = {}
 
 async def is_subscribed(bot, query, channel):
     btn = []
@@ -1,4 +1,3 @@
-import math
 import secrets
 import mimetypes
 import os
@@ -8,9 +7,15 @@ import logging
 from info import BIN_CHANNEL, ADMINS, PORT
 from utils import temp, get_size
 from aiohttp import web
-from web.utils.custom_dl import TGCustomYield, chunk_size, offset_fix, ByteStreamer
+from web.utils.custom_dl import TGCustomYield, get_streamer, chunk_flights
 from web.utils.render_template import media_watch, get_error_page
 from web.utils.file_properties import FileNotFound, get_hash
+from web.utils.chunk_cache import chunk_cache
+from web.utils.client_pool import get_client, track_workload
+from web.utils.http_range import send_stream_response
+from web.utils.chunk_planner import access_tracker
+from web.utils.stream_scheduler import stream_scheduler, get_viewer_key
+from web.utils.stream_stats import stream_stats
 from web.utils.admin_utils import admin_auth_required, get_session, set_session, clear_session, is_valid_admin, get_mock_activities, get_random_percentage_increase, get_formatted_date
 from database.file_mapping import get_message_id_from_file_id, get_file_id_from_message_id
 
@@ -1656,8 +1661,6 @@ async def media_download(request, message_id: int):
     with proper range request handling for better compatibility with media players.
     """
     try:
-        range_header = request.headers.get('Range', 0)
-        
         # Safely get the message
         if not temp.BOT:
             return web.Response(
@@ -1666,8 +1669,10 @@ async def media_download(request, message_id: int):
                 content_type="text/plain"
             )
             
-        # Initialize the ByteStreamer
-        byte_streamer = ByteStreamer(temp.BOT)
+        # Serve through the least busy client, reusing its streamer so file
+        # properties stay cached across requests
+        client_index, client = get_client()
+        byte_streamer = get_streamer(client)
         
         try:
             # Get file properties with the improved method
@@ -1711,39 +1716,6 @@ async def media_download(request, message_id: int):
                 content_type="text/plain"
             )
         
-        # Handle range requests
-        from_bytes = 0
-        until_bytes = 0
-        
-        if range_header:
-            from_bytes, until_bytes = range_header.replace('bytes=', '').split('-')
-            from_bytes = int(from_bytes)
-            until_bytes = int(until_bytes) if until_bytes else file_size - 1
-        else:
-            # If no range header, serve the full file
-            from_bytes = 0
-            until_bytes = file_size - 1
-
-        # Validate range
-        if (until_bytes >= file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
-            return web.Response(
-                status=416,
-                text="Range not satisfiable",
-                headers={"Content-Range": f"bytes */{file_size}"},
-                content_type="text/plain"
-            )
-        
-        # Calculate streaming parameters
-        chunk_size = 1024 * 1024  # 1 MB chunk size
-        until_bytes = min(until_bytes, file_size - 1)
-        
-        offset = from_bytes - (from_bytes % chunk_size)
-        first_part_cut = from_bytes - offset
-        last_part_cut = (until_bytes % chunk_size) + 1
-        
-        req_length = until_bytes - from_bytes + 1
-        part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-        
         # Determine MIME type and filename
         mime_type = file_id.mime_type
         file_name = file_id.file_name
@@ -1764,36 +1736,13 @@ async def media_download(request, message_id: int):
         if mime_type and mime_type.startswith(('video/', 'audio/', 'image/')):
             disposition = "inline"  # For media files, use inline disposition for browser playback
         
-        # Create response headers
-        headers = {
-            "Content-Type": mime_type,
-            "Accept-Ranges": "bytes",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"'
-        }
-        
-        if range_header:
-            headers["Content-Range"] = f"bytes {from_bytes}-{until_bytes}/{file_size}"
-            status_code = 206  # Partial Content
-        else:
-            status_code = 200  # OK
-        
-        # Get the file generator
-        body = byte_streamer.yield_file(
-            file_id,
-            offset,
-            first_part_cut,
-            last_part_cut,
-            part_count,
-            chunk_size
-        )
+        def yield_range(first, last, transfer):
+            # Seeks start with small requests, sequential reads with large ones
+            start_size = access_tracker.get_start_size(get_viewer_key(request), file_id.media_id, first, last)
+            return track_workload(client_index, byte_streamer.yield_range(file_id, first, last, start_size, get_viewer_key(request), transfer))
         
-        # Return the streamresponse with the generator
-        return web.Response(
-            status=status_code,
-            body=body,
-            headers=headers
-        )
+        # Ranges, conditional requests and HEAD are handled by the shared layer
+        return await send_stream_response(request, file_id, yield_range, mime_type, file_name, disposition)
     except Exception as e:
         logging.error(f"Unexpected error in media_download: {str(e)}")
         return web.Response(
@@ -2583,8 +2532,68 @@ async def broadcast_to_groups(message, pin=False):
 @routes.get("/admin/index")
 @admin_auth_required
 async def admin_index(request):
-    """Render the admin index page"""
-    return web.Response(text="Admin Index Page - Not Implemented Yet", content_type='text/html')
+    """Render the status of the channel indexing jobs"""
+    rows = ""
+    for job in temp.INDEX_JOBS.values():
+        stats = job['stats']
+        started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['started_at'])) if job['started_at'] else '-'
+        rows += f"""
+                <tr>
+                    <td><code>{job['chat']}</code></td>
+                    <td>{job['status']}</td>
+                    <td>{stats['current']} / {job['last_msg_id']}</td>
+                    <td>{stats['total_files']}</td>
+                    <td>{stats['duplicate']}</td>
+                    <td>{stats['errors']}</td>
+                    <td>{started}</td>
+                </tr>"""
+    if not rows:
+        rows = '<tr><td colspan="7" class="text-center">No indexing jobs yet, start one with /index in the bot.</td></tr>'
+    html = f"""
+    <!DOCTYPE html>
+    <html lang="en" data-bs-theme="dark">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <meta http-equiv="refresh" content="10">
+        <title>Indexing | Admin Dashboard</title>
+        <link rel="stylesheet" href="https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css">
+    </head>
+    <body>
+        <div class="container py-4">
+            <a href="/admin" class="btn btn-secondary mb-3">Back to Dashboard</a>
+            <h2 class="mb-3">Indexing Jobs</h2>
+            <table class="table table-striped">
+                <thead>
+                    <tr>
+                        <th>Channel</th>
+                        <th>Status</th>
+                        <th>Messages</th>
+                        <th>Saved</th>
+                        <th>Duplicates</th>
+                        <th>Errors</th>
+                        <th>Started</th>
+                    </tr>
+                </thead>
+                <tbody>{rows}
+                </tbody>
+            </table>
+        </div>
+    </body>
+    </html>
+    """
+    return web.Response(text=html, content_type='text/html')
+
+@routes.get("/admin/stream-stats")
+@admin_auth_required
+async def admin_stream_stats(request):
+    """Return the streaming cache statistics as JSON"""
+    return web.json_response({
+        'disk_cache': chunk_cache.get_stats(),
+        'coalescing': chunk_flights.get_stats(),
+        'scheduler': stream_scheduler.get_stats(),
+        'transfers': stream_stats.get_stats(),
+    })
 
 @routes.get("/admin/backup")
 @admin_auth_required
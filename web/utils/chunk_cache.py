@@ -0,0 +1,179 @@
+"""
+On-disk cache of the chunks streamed from Telegram.
+
+Chunks are stored as fixed-size blocks aligned to BLOCK_SIZE, one file per
+(media_id, block index) under STREAM_DISK_CACHE_DIR, so the same bytes
+fetched by requests of different sizes are stored once and any request
+covered by cached blocks is a hit. Blocks are evicted least recently used
+first once the cache grows past STREAM_DISK_CACHE_SIZE megabytes. Disk
+reads and writes run in the default executor so they never block the
+event loop.
+"""
+import os
+import asyncio
+import logging
+import tempfile
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from info import STREAM_DISK_CACHE_DIR, STREAM_DISK_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Smaller requests are served from the block holding them, but not stored
+BLOCK_SIZE = 64 * 1024
+class ChunkCache:
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # (media_id, block index) -> size of the block file, least recently used first
+        self.entries: "OrderedDict[tuple, int]" = OrderedDict()
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self.load_entries()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def load_entries(self):
+        """Pick up the blocks left on disk by a previous run, oldest first"""
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                media_id, index = (int(part) for part in name.split('_'))
+                stat = os.stat(path)
+            except (ValueError, OSError):
+                # Temporary files of interrupted writes and chunks of older versions
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            files.append((stat.st_mtime, (media_id, index), stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        self.evict()
+
+    def get_path(self, key: tuple) -> str:
+        return os.path.join(self.directory, '_'.join(str(part) for part in key))
+
+    async def get(self, media_id: int, offset: int, limit: int) -> Optional[bytes]:
+        """Return a cached chunk, or None unless every block it covers is cached"""
+        first_index = offset // BLOCK_SIZE
+        keys = []
+        for index in range(first_index, (offset + limit - 1) // BLOCK_SIZE + 1):
+            key = (media_id, index)
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            keys.append(key)
+            if self.entries[key] < BLOCK_SIZE:
+                # The last block of the file
+                break
+        try:
+            blocks = await asyncio.get_running_loop().run_in_executor(
+                None, self.read_files, [self.get_path(key) for key in keys]
+            )
+        except OSError as e:
+            logger.warning(f"Dropping unreadable cached chunk {(media_id, offset, limit)}: {e}")
+            for key in keys:
+                self.remove(key)
+            self.misses += 1
+            return None
+        for key in keys:
+            # Removed while reading
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        self.hits += 1
+        data = b''.join(blocks)
+        start = offset - first_index * BLOCK_SIZE
+        if start == 0 and len(data) <= limit:
+            return data
+        return data[start:start + limit]
+
+    async def put(self, media_id: int, offset: int, limit: int, data: bytes):
+        """Store the whole blocks of a chunk and evict the least recently used ones past the size limit"""
+        if not data or offset % BLOCK_SIZE:
+            return
+        view = memoryview(data)
+        blocks = []
+        for start in range(0, len(data), BLOCK_SIZE):
+            block = view[start:start + BLOCK_SIZE]
+            # A short block is only whole at the end of the file
+            if len(block) < BLOCK_SIZE and len(data) == limit:
+                break
+            key = (media_id, (offset + start) // BLOCK_SIZE)
+            if key not in self.entries:
+                blocks.append((key, block))
+        if not blocks or sum(len(block) for _, block in blocks) > self.max_size:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.write_files, self.directory, [(self.get_path(key), block) for key, block in blocks]
+            )
+        except OSError as e:
+            logger.warning(f"Could not cache chunk {(media_id, offset, limit)}: {e}")
+            return
+        for key, block in blocks:
+            if key not in self.entries:
+                self.entries[key] = len(block)
+                self.size += len(block)
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key: tuple):
+        self.size -= self.entries.pop(key, 0)
+        try:
+            os.remove(self.get_path(key))
+        except OSError:
+            pass
+
+    @staticmethod
+    def read_files(paths: List[str]) -> List[bytes]:
+        blocks = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                blocks.append(f.read())
+        return blocks
+
+    @staticmethod
+    def write_files(directory: str, blocks: List[Tuple[str, memoryview]]):
+        for path, data in blocks:
+            # Write under a unique temporary name so a reader never sees half a
+            # block and concurrent writers of the same block don't collide
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else 0,
+            'blocks': len(self.entries),
+            'size': self.size,
+            'max_size': self.max_size,
+        }
+
+# Initialize the cache singleton
+chunk_cache = ChunkCache(STREAM_DISK_CACHE_DIR, STREAM_DISK_CACHE_SIZE * 1024 * 1024)
@@ -0,0 +1,75 @@
+"""
+Plans the upload.GetFile requests used to stream a byte range.
+
+Telegram only accepts a limit that is a power of two between 4 KiB and
+1 MiB, at an offset divisible by 4 KiB, without crossing a 1 MiB boundary.
+Every request planned here is aligned to its own size, which satisfies
+all three. Seeks start with small requests for a fast first byte and
+double the size as the read goes on, while reads that continue where the
+previous request of the same viewer ended start at the largest size.
+"""
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+MIN_CHUNK_SIZE = 4 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+# First request size of a seek
+SEEK_CHUNK_SIZE = 64 * 1024
+
+def fit_chunk_size(size: int) -> int:
+    """Round a size up to a power of two within the GetFile limits"""
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < size and chunk_size < MAX_CHUNK_SIZE:
+        chunk_size *= 2
+    return chunk_size
+
+def plan_chunks(first: int, last: int, start_size: int = MAX_CHUNK_SIZE) -> List[Tuple[int, int]]:
+    """
+    Return the (offset, limit) requests covering the bytes first to last.
+    Sizes start at start_size, or less for a shorter range, and double up
+    to MAX_CHUNK_SIZE whenever the offset is aligned to the doubled size.
+    """
+    chunk_size = fit_chunk_size(min(start_size, last - first + 1))
+    offset = first - first % chunk_size
+    parts = []
+    while offset <= last:
+        parts.append((offset, chunk_size))
+        offset += chunk_size
+        if chunk_size < MAX_CHUNK_SIZE and offset % (chunk_size * 2) == 0:
+            chunk_size *= 2
+    return parts
+
+def cut_chunk(chunk: bytes, offset: int, first: int, last: int) -> Union[bytes, memoryview]:
+    """
+    Return the bytes first to last of a chunk fetched at offset. Partial
+    chunks are memoryview slices, so no bytes are copied on the way to the
+    socket.
+    """
+    start = max(first - offset, 0)
+    end = min(last - offset + 1, len(chunk))
+    if start == 0 and end == len(chunk):
+        return chunk
+    return memoryview(chunk)[start:end]
+
+class AccessTracker:
+    def __init__(self, max_entries: int = 4096):
+        """Remembers where the last range of each viewer and file ended"""
+        self.max_entries = max_entries
+        self.positions: "OrderedDict[tuple, int]" = OrderedDict()
+
+    def get_start_size(self, viewer: str, media_id: int, first: int, last: int) -> int:
+        """
+        Return the first request size for a range and record where it ends.
+        A range following the previous one is a sequential read.
+        """
+        key = (viewer, media_id)
+        sequential = self.positions.get(key) == first
+        self.positions[key] = last + 1
+        self.positions.move_to_end(key)
+        while len(self.positions) > self.max_entries:
+            self.positions.popitem(last=False)
+        if sequential:
+            return MAX_CHUNK_SIZE
+        return SEEK_CHUNK_SIZE
+
+access_tracker = AccessTracker()
@@ -0,0 +1,68 @@
+"""
+Pool of bot clients used to stream files.
+
+Besides the main bot, every token in MULTI_TOKENS is started as a light
+worker client without update handling. Each stream is served by the
+client with the fewest active streams, so streaming capacity grows with
+the number of tokens. Worker bots must be admins in BIN_CHANNEL.
+"""
+import logging
+from typing import AsyncGenerator, Tuple
+from pyrogram import Client
+from info import API_ID, API_HASH, MULTI_TOKENS
+from utils import temp
+
+logger = logging.getLogger(__name__)
+
+async def start_clients(bot: Client):
+    """Register the main bot and start the worker clients of MULTI_TOKENS"""
+    temp.MULTI_CLIENTS[0] = bot
+    temp.WORK_LOADS[0] = 0
+    for index, token in enumerate(MULTI_TOKENS, start=1):
+        client = Client(
+            name=f'worker_{index}',
+            api_id=API_ID,
+            api_hash=API_HASH,
+            bot_token=token,
+            no_updates=True,
+            in_memory=True
+        )
+        try:
+            await client.start()
+        except Exception as e:
+            logger.error(f"Could not start worker client {index}: {e}")
+            continue
+        temp.MULTI_CLIENTS[index] = client
+        temp.WORK_LOADS[index] = 0
+    if len(temp.MULTI_CLIENTS) > 1:
+        logger.info(f"Streaming through {len(temp.MULTI_CLIENTS)} clients")
+
+async def stop_clients():
+    """Stop the worker clients, the main bot stops on its own"""
+    for index, client in list(temp.MULTI_CLIENTS.items()):
+        if index == 0:
+            continue
+        try:
+            await client.stop()
+        except Exception as e:
+            logger.error(f"Could not stop worker client {index}: {e}")
+        temp.MULTI_CLIENTS.pop(index, None)
+        temp.WORK_LOADS.pop(index, None)
+
+def get_client() -> Tuple[int, Client]:
+    """Return the index and client with the fewest active streams"""
+    if not temp.MULTI_CLIENTS:
+        return 0, temp.BOT
+    index = min(temp.WORK_LOADS, key=temp.WORK_LOADS.get)
+    return index, temp.MULTI_CLIENTS[index]
+
+async def track_workload(index: int, body: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+    """Count a stream against the workload of its client while it is being sent"""
+    temp.WORK_LOADS[index] = temp.WORK_LOADS.get(index, 0) + 1
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        if index in temp.WORK_LOADS:
+            temp.WORK_LOADS[index] -= 1
+        await body.aclose()
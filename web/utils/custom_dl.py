@@ -1,14 +1,22 @@
 import math
+import time
 import asyncio
 import logging
-from typing import Dict, Union, AsyncGenerator, Optional
+from collections import OrderedDict, deque
+from typing import Dict, List, Tuple, Union, AsyncGenerator, Optional
 from pyrogram.types import Message
 from utils import temp
+from info import STREAM_CACHE_SIZE, STREAM_CACHE_TTL, STREAM_PREFETCH, STREAM_CHUNK_LINGER
 from pyrogram import Client, utils, raw
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session import Session
+from pyrogram.errors import FileReferenceExpired
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 from web.utils.file_properties import get_file_ids, FileNotFound
+from web.utils.chunk_cache import chunk_cache
+from web.utils.media_sessions import media_sessions
+from web.utils.chunk_planner import MAX_CHUNK_SIZE, plan_chunks, cut_chunk
+from web.utils.stream_scheduler import stream_scheduler
+from web.utils.stream_stats import StreamTransfer
 
 # For backwards compatibility
 async def chunk_size(length):
@@ -43,48 +51,7 @@ class TGCustomYield:
 
     async def generate_media_session(self, client: Client, msg: Message):
         data = await self.generate_file_properties(msg)
-
-        media_session = client.media_sessions.get(data.dc_id, None)
-
-        if media_session is None:
-            if data.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client, data.dc_id, await Auth(client, data.dc_id, await client.storage.test_mode()).create(),
-                    await client.storage.test_mode(), is_media=True
-                )
-                await media_session.start()
-
-                for _ in range(3):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(
-                            dc_id=data.dc_id
-                        )
-                    )
-
-                    try:
-                        await media_session.send(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id,
-                                bytes=exported_auth.bytes
-                            )
-                        )
-                    except AuthBytesInvalid:
-                        continue
-                    else:
-                        break
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client, data.dc_id, await client.storage.auth_key(),
-                    await client.storage.test_mode(), is_media=True
-                )
-                await media_session.start()
-
-            client.media_sessions[data.dc_id] = media_session
-
-        return media_session
+        return await media_sessions.get_session(client, data.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId):
@@ -214,39 +181,112 @@ class TGCustomYield:
             return m_file
 
 
+class ChunkFlights:
+    def __init__(self, linger: float, max_lingering: int = 32):
+        """Coalesces concurrent fetches of the same chunk.
+        The first request of a (media_id, offset, limit) key fetches it and every
+        concurrent request of that key waits on the same fetch, which is only
+        cancelled once none of them wants it anymore. Fetched chunks linger in
+        memory for a few seconds so viewers slightly behind share them too.
+        """
+        self.linger = linger
+        self.max_lingering = max_lingering
+        self.inflight: Dict[tuple, list] = {}
+        self.lingering: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.fetched = 0
+        self.shared = 0
+
+    async def get(self, key: tuple, fetch) -> Optional[bytes]:
+        lingering = self.lingering.get(key)
+        if lingering and lingering[1] > time.monotonic():
+            self.shared += 1
+            return lingering[0]
+        flight = self.inflight.get(key)
+        if flight is None:
+            future = asyncio.ensure_future(fetch())
+            flight = self.inflight[key] = [future, 0]
+            future.add_done_callback(lambda f: self.land(key, f))
+            self.fetched += 1
+        else:
+            self.shared += 1
+        flight[1] += 1
+        try:
+            return await asyncio.shield(flight[0])
+        finally:
+            flight[1] -= 1
+            if not flight[1] and not flight[0].done():
+                flight[0].cancel()
+
+    def land(self, key: tuple, future: asyncio.Future):
+        if self.inflight.get(key, [None])[0] is future:
+            del self.inflight[key]
+        if future.cancelled() or future.exception() or not future.result() or self.linger <= 0:
+            return
+        now = time.monotonic()
+        self.lingering[key] = (future.result(), now + self.linger)
+        self.lingering.move_to_end(key)
+        while self.lingering:
+            oldest = next(iter(self.lingering))
+            if self.lingering[oldest][1] > now and len(self.lingering) <= self.max_lingering:
+                break
+            del self.lingering[oldest]
+
+    def get_stats(self) -> dict:
+        return {
+            'fetched': self.fetched,
+            'shared': self.shared,
+            'in_flight': len(self.inflight),
+            'lingering': len(self.lingering),
+        }
+
+# Shared by every streamer so all viewers of a file coalesce
+chunk_flights = ChunkFlights(STREAM_CHUNK_LINGER)
+
+
 # New improved ByteStreamer class
 class ByteStreamer:
     def __init__(self, client: Client = None):
         """A custom class that holds the cache of a specific client and class functions.
         attributes:
             client: the client that the cache is for.
-            cached_file_ids: a dict of cached file IDs.
+            cached_file_ids: an LRU of cached file IDs with the time they were cached,
+                bounded by STREAM_CACHE_SIZE and expiring after STREAM_CACHE_TTL.
+                Expired file references are refreshed in place while streaming.
+
+        Use get_streamer() instead of building one per request, so the cache
+        is shared by every request served through the same client.
         
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
             generate_media_session: returns the media session for the DC that contains the media file.
             yield_file: yield a file from telegram servers for streaming.
         """
-        self.clean_timer = 30 * 60
         self.client = client or temp.BOT
-        self.cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
+        self.cached_file_ids: "OrderedDict[int, tuple]" = OrderedDict()
+        self.pending_file_ids: Dict[int, asyncio.Future] = {}
+        self.pending_refreshes: Dict[int, asyncio.Future] = {}
 
     async def get_file_properties(self, id: int) -> FileId:
         """
         Returns the properties of a media of a specific message in a FileId class.
         If the properties are cached, then it'll return the cached results.
-        Or it'll generate the properties from the Message ID and cache them.
+        Or it'll generate the properties from the Message ID and cache them,
+        concurrent requests for the same ID sharing a single lookup.
         """
-        if id not in self.cached_file_ids:
-            from info import BIN_CHANNEL
-            try:
-                await self.generate_file_properties(id)
-                logging.debug(f"Cached file properties for message with ID {id}")
-            except Exception as e:
-                logging.error(f"Error generating file properties for message {id}: {e}")
-                raise FileNotFound(f"Could not find file for message ID {id}")
-        return self.cached_file_ids[id]
+        cached = self.cached_file_ids.get(id)
+        if cached and time.monotonic() - cached[1] < STREAM_CACHE_TTL:
+            self.cached_file_ids.move_to_end(id)
+            return cached[0]
+        pending = self.pending_file_ids.get(id)
+        if pending is None:
+            pending = asyncio.ensure_future(self.generate_file_properties(id))
+            self.pending_file_ids[id] = pending
+            pending.add_done_callback(lambda _: self.pending_file_ids.pop(id, None))
+        try:
+            return await asyncio.shield(pending)
+        except Exception as e:
+            logging.error(f"Error generating file properties for message {id}: {e}")
+            raise FileNotFound(f"Could not find file for message ID {id}")
     
     async def generate_file_properties(self, id: int) -> FileId:
         """
@@ -260,66 +300,43 @@ class ByteStreamer:
         if not file_id:
             logging.debug(f"Message with ID {id} not found")
             raise FileNotFound(f"Message with ID {id} not found")
-        self.cached_file_ids[id] = file_id
+        setattr(file_id, "message_id", id)
+        self.cached_file_ids[id] = (file_id, time.monotonic())
+        self.cached_file_ids.move_to_end(id)
+        while len(self.cached_file_ids) > STREAM_CACHE_SIZE:
+            self.cached_file_ids.popitem(last=False)
         logging.debug(f"Cached media message with ID {id}")
-        return self.cached_file_ids[id]
+        return file_id
 
-    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+    async def refresh_file_reference(self, file_id: FileId, expired_reference: bytes) -> None:
         """
-        Generates the media session for the DC that contains the media file.
-        This is required for getting the bytes from Telegram servers.
+        Re-fetches the message of a file whose file_reference expired and swaps
+        the new reference into the cached FileId, so every stream of the file
+        picks it up. Concurrent callers share a single lookup.
         """
+        from info import BIN_CHANNEL
 
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await Auth(
-                        client, file_id.dc_id, await client.storage.test_mode()
-                    ).create(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-
-                for _ in range(6):
-                    exported_auth = await client.invoke(
-                        raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                    )
-
-                    try:
-                        await media_session.send(
-                            raw.functions.auth.ImportAuthorization(
-                                id=exported_auth.id, bytes=exported_auth.bytes
-                            )
-                        )
-                        break
-                    except AuthBytesInvalid:
-                        logging.debug(
-                            f"Invalid authorization bytes for DC {file_id.dc_id}"
-                        )
-                        continue
-                else:
-                    await media_session.stop()
-                    raise AuthBytesInvalid
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logging.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        else:
-            logging.debug(f"Using cached media session for DC {file_id.dc_id}")
-        return media_session
+        if file_id.file_reference != expired_reference:
+            # Another stream refreshed it already
+            return
+        id = getattr(file_id, "message_id", None)
+        if id is None:
+            raise FileNotFound("Can't refresh the file reference of an unknown message")
+        pending = self.pending_refreshes.get(id)
+        if pending is None:
+            pending = asyncio.ensure_future(get_file_ids(self.client, BIN_CHANNEL, id))
+            self.pending_refreshes[id] = pending
+            pending.add_done_callback(lambda _: self.pending_refreshes.pop(id, None))
+        new_file_id = await asyncio.shield(pending)
+        file_id.file_reference = new_file_id.file_reference
+        logging.debug(f"Refreshed file reference for message with ID {id}")
 
+    async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
+        """
+        Returns the media session for the DC that contains the media file.
+        This is required for getting the bytes from Telegram servers.
+        """
+        return await media_sessions.get_session(client, file_id.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
@@ -376,58 +393,140 @@ class ByteStreamer:
         chunk_size: int,
     ) -> AsyncGenerator[bytes, None]:
         """
-        Custom generator that yields the bytes of the media file.
+        Custom generator that yields the bytes of the media file in part_count
+        requests of chunk_size.
+        """
+        parts = [(offset + part * chunk_size, chunk_size) for part in range(part_count)]
+        last = offset + (part_count - 1) * chunk_size + last_part_cut - 1
+        async for chunk in self.yield_parts(file_id, parts, offset + first_part_cut, last):
+            yield chunk
+
+    def yield_range(
+        self,
+        file_id: FileId,
+        first: int,
+        last: int,
+        start_size: int = MAX_CHUNK_SIZE,
+        viewer: Optional[str] = None,
+        transfer: Optional[StreamTransfer] = None,
+    ) -> AsyncGenerator[bytes, None]:
+        """
+        Yields the bytes first to last of the media file, fetched in the
+        requests planned by plan_chunks starting at start_size.
+        """
+        return self.yield_parts(file_id, plan_chunks(first, last, start_size), first, last, viewer, transfer)
+
+    async def yield_parts(
+        self,
+        file_id: FileId,
+        parts: List[Tuple[int, int]],
+        first: int,
+        last: int,
+        viewer: Optional[str] = None,
+        transfer: Optional[StreamTransfer] = None,
+    ) -> AsyncGenerator[Union[bytes, memoryview], None]:
+        """
+        Yields the bytes first to last fetched by the (offset, limit) requests of parts,
+        cutting the first and last chunks as memoryview slices without a copy.
+
+        Up to STREAM_PREFETCH chunks are requested ahead of the one being
+        yielded and handed out in offset order. A new request is only sent
+        when a chunk is consumed, so a slow client holds back the fetching.
+        Requests go through chunk_flights, so concurrent streams of the same
+        file share their upstream fetches. They are striped round-robin over
+        the STREAM_SESSIONS_PER_DC media sessions of the file's DC, the
+        in-order hand out acting as a reorder buffer bounded by the window.
+        Fetches wait for a slot of stream_scheduler, shared fairly between
+        the (viewer, file) flows. The bytes of every fetch that completes,
+        consumed or not, are counted in transfer.fetched. Closing the
+        generator cancels the fetches still in flight.
         """
         client = self.client
         
-        logging.debug(f"Starting to yield file with {part_count} parts.")
-        media_session = await self.generate_media_session(client, file_id)
+        logging.debug(f"Starting to yield file with {len(parts)} parts.")
+        sessions = await media_sessions.get_sessions(client, file_id.dc_id)
 
         current_part = 1
-        location = await self.get_location(file_id)
 
-        try:
-            r = await media_session.send(
-                raw.functions.upload.GetFile(
-                    location=location, offset=offset, limit=chunk_size
-                ),
-            )
+        async def download_chunk(chunk_offset, limit, media_session):
+            if chunk_cache.enabled:
+                chunk = await chunk_cache.get(file_id.media_id, chunk_offset, limit)
+                if chunk:
+                    return chunk
+            for attempt in range(2):
+                # Built per request to pick up a refreshed file reference
+                location = await self.get_location(file_id)
+                try:
+                    async with stream_scheduler.fetch_slot((viewer, file_id.media_id), limit):
+                        r = await media_session.send(
+                            raw.functions.upload.GetFile(
+                                location=location, offset=chunk_offset, limit=limit
+                            ),
+                        )
+                    break
+                except FileReferenceExpired:
+                    if attempt:
+                        raise
+                    # Resume at the same offset with a fresh reference
+                    await self.refresh_file_reference(file_id, getattr(location, "file_reference", None))
             if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
-
-                    current_part += 1
-                    offset += chunk_size
-
-                    if current_part > part_count:
-                        break
-
-                    r = await media_session.send(
-                        raw.functions.upload.GetFile(
-                            location=location, offset=offset, limit=chunk_size
-                        ),
-                    )
+                if chunk_cache.enabled:
+                    await chunk_cache.put(file_id.media_id, chunk_offset, limit, r.bytes)
+                return r.bytes
+            return None
+
+        def fetch_chunk(chunk_offset, limit, media_session):
+            return chunk_flights.get(
+                (file_id.media_id, chunk_offset, limit),
+                lambda: download_chunk(chunk_offset, limit, media_session)
+            )
+
+        pending = deque()
+        remaining_parts = enumerate(parts)
+
+        def count_fetched(task):
+            if not task.cancelled() and not task.exception() and task.result():
+                transfer.fetched += len(task.result())
+
+        def request_next():
+            index, part = next(remaining_parts, (None, None))
+            if part:
+                media_session = sessions[index % len(sessions)]
+                task = asyncio.ensure_future(fetch_chunk(*part, media_session))
+                if transfer is not None:
+                    task.add_done_callback(count_fetched)
+                pending.append((part[0], task))
+
+        try:
+            for _ in range(max(STREAM_PREFETCH, len(sessions), 1)):
+                request_next()
+            while pending:
+                chunk_offset, task = pending.popleft()
+                chunk = await task
+                if not chunk:
+                    break
+                request_next()
+                yield cut_chunk(chunk, chunk_offset, first, last)
+
+                current_part += 1
         except (TimeoutError, AttributeError):
             pass
         finally:
+            for _, task in pending:
+                task.cancel()
             logging.debug(f"Finished yielding file with {current_part} parts.")
 
-    
-    async def clean_cache(self) -> None:
-        """
-        Function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logging.debug("Cleaned the file properties cache")
+
+# One long-lived streamer per client
+streamers: Dict[Client, ByteStreamer] = {}
+
+def get_streamer(client: Client = None) -> ByteStreamer:
+    """
+    Returns the ByteStreamer of a client, creating it on first use.
+    """
+    client = client or temp.BOT
+    streamer = streamers.get(client)
+    if streamer is None:
+        streamer = streamers[client] = ByteStreamer(client)
+    return streamer
+
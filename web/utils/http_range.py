@@ -0,0 +1,227 @@
+"""
+Range and conditional request handling shared by the stream routes.
+
+Implements byte ranges as in RFC 7233 (single, open-ended, suffix and
+multiple ranges served as multipart/byteranges) along with If-Range and
+If-None-Match against a strong ETag derived from the file_unique_id.
+HEAD requests are answered from the file properties without streaming.
+Only responses with a body take a slot of stream_scheduler, and bodies
+are written here so a viewer leaving stops the upstream fetches right
+away.
+"""
+import asyncio
+import logging
+import secrets
+from typing import AsyncGenerator, Callable, List, Optional, Tuple
+from aiohttp import web
+from pyrogram.file_id import FileId
+from web.utils.stream_scheduler import stream_scheduler, StreamRejected, get_client_address, get_viewer_key
+from web.utils.stream_stats import stream_stats, StreamTransfer
+
+logger = logging.getLogger(__name__)
+
+# More ranges than this in one request are refused
+MAX_RANGES = 16
+# Seconds between checks of the connection of a viewer
+DISCONNECT_POLL_INTERVAL = 0.5
+
+class RangeNotSatisfiable(Exception):
+    """
+    Exception raised when none of the requested ranges overlaps the file.
+    """
+
+def parse_range_header(header: Optional[str], size: int) -> Optional[List[Tuple[int, int]]]:
+    """
+    Parse a Range header into sorted, merged (first, last) byte positions.
+    Returns None when the header is missing or invalid, which means the
+    whole file is served, and raises RangeNotSatisfiable when no range
+    overlaps the file.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = (item.strip() for item in part.partition('-'))
+        if not sep or not (start or end) or (start and not start.isdigit()) or (end and not end.isdigit()):
+            return None
+        if not start:
+            # Suffix range, the last `end` bytes of the file
+            length = int(end)
+            if length and size:
+                ranges.append((max(size - length, 0), size - 1))
+            continue
+        first = int(start)
+        if end and int(end) < first:
+            return None
+        if first < size:
+            ranges.append((first, min(int(end), size - 1) if end else size - 1))
+    if not ranges:
+        raise RangeNotSatisfiable
+    ranges.sort()
+    merged = [ranges[0]]
+    for first, last in ranges[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    if len(merged) > MAX_RANGES:
+        raise RangeNotSatisfiable
+    return merged
+
+def get_etag(file_id: FileId) -> str:
+    """Strong ETag of a file, the file_unique_id never changes for the same bytes"""
+    return f'"{file_id.unique_id}"'
+
+def etag_matches(header: Optional[str], etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in (tag.strip().removeprefix('W/') for tag in header.split(','))
+
+async def send_stream_response(
+    request: web.Request,
+    file_id: FileId,
+    yield_range: Callable[[int, int, StreamTransfer], AsyncGenerator[bytes, None]],
+    mime_type: str,
+    file_name: str,
+    disposition: str = "attachment",
+) -> web.StreamResponse:
+    """
+    Answer a stream request.
+    yield_range(first, last, transfer) must return a generator of exactly those
+    bytes, counting what it fetches upstream in transfer.fetched. It is only
+    called when the response carries a body, which is written here so the
+    generator is closed, cancelling its outstanding fetches, as soon as the
+    viewer goes away. Streams past the cap of stream_scheduler wait for a
+    slot, held until the body is written, or get a 503.
+    """
+    file_size = file_id.file_size
+    etag = get_etag(file_id)
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+    }
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+
+    range_header = request.headers.get("Range")
+    # A range only applies to the version of the file the client already has
+    if_range = request.headers.get("If-Range")
+    if range_header and if_range and if_range.strip() != etag:
+        range_header = None
+    try:
+        ranges = parse_range_header(range_header, file_size)
+    except RangeNotSatisfiable:
+        return web.Response(
+            status=416,
+            text="Range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"},
+            content_type="text/plain"
+        )
+
+    if not ranges:
+        status = 200
+        headers["Content-Type"] = mime_type
+        headers["Content-Length"] = str(file_size)
+        make_body = lambda transfer: yield_range(0, file_size - 1, transfer)
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        status = 206
+        headers["Content-Type"] = mime_type
+        headers["Content-Range"] = f"bytes {first}-{last}/{file_size}"
+        headers["Content-Length"] = str(last - first + 1)
+        make_body = lambda transfer: yield_range(first, last, transfer)
+    else:
+        boundary = secrets.token_hex(16)
+        part_heads = [
+            f"\r\n--{boundary}\r\nContent-Type: {mime_type}\r\nContent-Range: bytes {first}-{last}/{file_size}\r\n\r\n".encode()
+            for first, last in ranges
+        ]
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        status = 206
+        headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(
+            sum(len(head) + last - first + 1 for head, (first, last) in zip(part_heads, ranges)) + len(tail)
+        )
+
+        async def make_body(transfer):
+            for head, (first, last) in zip(part_heads, ranges):
+                yield head
+                part = yield_range(first, last, transfer)
+                try:
+                    async for chunk in part:
+                        yield chunk
+                finally:
+                    await part.aclose()
+            yield tail
+
+    if request.method == "HEAD":
+        return web.Response(status=status, headers=headers)
+
+    try:
+        ticket = await stream_scheduler.admit(get_client_address(request))
+    except StreamRejected as e:
+        return web.Response(
+            status=503,
+            text=e.message,
+            headers={"Retry-After": str(e.retry_after)},
+            content_type="text/plain"
+        )
+    try:
+        return await write_body(request, file_id, status, headers, ranges, make_body)
+    finally:
+        ticket.release()
+
+async def write_body(request, file_id, status, headers, ranges, make_body):
+    file_size = file_id.file_size
+    response = web.StreamResponse(status=status, headers=headers)
+    transfer = stream_stats.start(get_viewer_key(request), file_id.media_id, ranges or [(0, file_size - 1)])
+    body = make_body(transfer)
+    writer = asyncio.current_task()
+
+    async def watch_disconnect():
+        # Writes only fail once the next chunk is ready, so check the
+        # transport while the pipeline is still fetching
+        while True:
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+            if request.transport is None or request.transport.is_closing():
+                transfer.disconnected = True
+                writer.cancel()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        await response.prepare(request)
+        async for chunk in body:
+            # Chunks may be memoryview slices, written without a copy. write()
+            # drains the transport whenever its buffer is past the high-water
+            # mark, so a slow viewer holds back the pipeline
+            await response.write(chunk)
+            transfer.delivered += len(chunk)
+        await response.write_eof()
+    except (ConnectionResetError, ConnectionError):
+        transfer.disconnected = True
+    except asyncio.CancelledError:
+        if not transfer.disconnected:
+            raise
+        # Cancelled by the watcher, the viewer is gone
+        writer.uncancel()
+    except Exception as e:
+        if not response.prepared:
+            raise
+        # The headers are sent already, all that is left is cutting the body short
+        logger.error(f"Error streaming media {file_id.media_id}: {e}")
+    finally:
+        watcher.cancel()
+        # Closing the body cancels the fetches still in flight
+        await body.aclose()
+        stream_stats.finish(transfer)
+    return response
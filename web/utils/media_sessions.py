@@ -0,0 +1,180 @@
+"""
+Media sessions used to download files from the Telegram DCs.
+
+Sessions are created once per client and DC under a lock, so concurrent
+first requests never authorize twice. With STREAM_SESSIONS_PER_DC above
+one, extra sessions are kept per DC so a download can be striped across
+them. At startup sessions are warmed up for the DCs holding the catalog,
+and a health check pings every session periodically, replacing dead ones
+before a viewer hits them.
+"""
+import random
+import asyncio
+import logging
+from typing import Dict, Iterable, List
+from pyrogram import Client, raw
+from pyrogram.session import Session, Auth
+from pyrogram.errors import AuthBytesInvalid
+from info import MEDIA_SESSION_PING_INTERVAL, STREAM_SESSIONS_PER_DC
+from utils import temp
+
+logger = logging.getLogger(__name__)
+
+class MediaSessionManager:
+    def __init__(self, ping_interval: int, ping_timeout: int = 15):
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.locks: Dict[tuple, asyncio.Lock] = {}
+        # Sessions beyond the client's own media session, per client and DC
+        self.extra_sessions: Dict[tuple, List[Session]] = {}
+        self.replaced = 0
+
+    def get_lock(self, client: Client, dc_id: int) -> asyncio.Lock:
+        key = (id(client), dc_id)
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    async def get_session(self, client: Client, dc_id: int) -> Session:
+        """Return the media session of a client for a DC, creating it once"""
+        media_session = client.media_sessions.get(dc_id)
+        if media_session is not None:
+            return media_session
+        async with self.get_lock(client, dc_id):
+            media_session = client.media_sessions.get(dc_id)
+            if media_session is None:
+                media_session = await self.create_session(client, dc_id)
+                client.media_sessions[dc_id] = media_session
+        return media_session
+
+    async def get_sessions(self, client: Client, dc_id: int, count: int = STREAM_SESSIONS_PER_DC) -> List[Session]:
+        """Return up to count sessions of a client for a DC, its own media session first"""
+        sessions = [await self.get_session(client, dc_id)]
+        if count <= 1:
+            return sessions
+        extra = self.extra_sessions.setdefault((id(client), dc_id), [])
+        if len(extra) < count - 1:
+            async with self.get_lock(client, dc_id):
+                try:
+                    while len(extra) < count - 1:
+                        extra.append(await self.create_session(client, dc_id))
+                except Exception as e:
+                    # Stream through the sessions there are, the next request tries again
+                    logger.error(f"Could not create extra media session for DC {dc_id}: {e}")
+        return sessions + extra[:count - 1]
+
+    @staticmethod
+    async def create_session(client: Client, dc_id: int) -> Session:
+        """Start a media session for a DC, exporting the authorization to other DCs"""
+        if dc_id != await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await Auth(
+                    client, dc_id, await client.storage.test_mode()
+                ).create(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+
+            for _ in range(6):
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+
+                try:
+                    await media_session.send(
+                        raw.functions.auth.ImportAuthorization(
+                            id=exported_auth.id, bytes=exported_auth.bytes
+                        )
+                    )
+                    break
+                except AuthBytesInvalid:
+                    logger.debug(f"Invalid authorization bytes for DC {dc_id}")
+                    continue
+            else:
+                await media_session.stop()
+                raise AuthBytesInvalid
+        else:
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+        logger.debug(f"Created media session for DC {dc_id}")
+        return media_session
+
+    async def warm_up(self, clients: Iterable[Client], dc_ids: List[int]):
+        """Create the sessions of every client for the given DCs"""
+        tasks = [self.get_sessions(client, dc_id) for client in clients for dc_id in dc_ids]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed = sum(isinstance(result, Exception) for result in results)
+        logger.info(f"Warmed up media sessions for DCs {dc_ids}, {failed} failed")
+
+    async def is_alive(self, media_session: Session) -> bool:
+        try:
+            await asyncio.wait_for(
+                media_session.send(raw.functions.Ping(ping_id=random.getrandbits(63))),
+                self.ping_timeout
+            )
+            return True
+        except Exception:
+            return False
+
+    async def check_sessions(self, client: Client):
+        """Replace the sessions of a client that don't answer a ping"""
+        for dc_id, media_session in list(client.media_sessions.items()):
+            if await self.is_alive(media_session):
+                continue
+            logger.warning(f"Media session for DC {dc_id} is not responding, replacing it")
+            async with self.get_lock(client, dc_id):
+                if client.media_sessions.get(dc_id) is not media_session:
+                    continue
+                client.media_sessions.pop(dc_id, None)
+                try:
+                    await media_session.stop()
+                except Exception:
+                    pass
+                try:
+                    client.media_sessions[dc_id] = await self.create_session(client, dc_id)
+                    self.replaced += 1
+                except Exception as e:
+                    # The next request of this DC will try again
+                    logger.error(f"Could not replace media session for DC {dc_id}: {e}")
+        for (client_id, dc_id), extra in list(self.extra_sessions.items()):
+            if client_id != id(client):
+                continue
+            for media_session in list(extra):
+                if await self.is_alive(media_session):
+                    continue
+                # Dead extra sessions are dropped and created again when needed
+                logger.warning(f"Extra media session for DC {dc_id} is not responding, dropping it")
+                if media_session in extra:
+                    extra.remove(media_session)
+                try:
+                    await media_session.stop()
+                except Exception:
+                    pass
+
+    async def run(self):
+        """Warm up the catalog DCs, then keep checking the sessions"""
+        from database.ia_filterdb import get_catalog_dc_ids
+        clients = list(temp.MULTI_CLIENTS.values()) or [temp.BOT]
+        try:
+            await self.warm_up(clients, await get_catalog_dc_ids())
+        except Exception as e:
+            logger.error(f"Error warming up media sessions: {e}")
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            for client in list(temp.MULTI_CLIENTS.values()) or [temp.BOT]:
+                try:
+                    await self.check_sessions(client)
+                except Exception as e:
+                    logger.error(f"Error checking media sessions: {e}")
+
+# Initialize the manager singleton
+media_sessions = MediaSessionManager(MEDIA_SESSION_PING_INTERVAL)
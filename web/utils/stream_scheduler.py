@@ -0,0 +1,186 @@
+"""
+Admission control and fair scheduling of the streams.
+
+At most STREAM_MAX_ACTIVE streams are served at once and at most
+STREAM_MAX_PER_IP per client address, which is only known when
+STREAM_TRUSTED_PROXIES is set. Streams past the cap wait in a queue of
+STREAM_MAX_QUEUE for up to STREAM_QUEUE_TIMEOUT seconds, and get a fast
+503 with Retry-After when the queue is full or the wait runs out.
+
+Upstream chunk fetches of the admitted streams share STREAM_FETCH_SLOTS
+slots, handed out by deficit round-robin over (address, file) flows so a
+viewer pulling a large file can't crowd out the others.
+"""
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+from info import STREAM_MAX_ACTIVE, STREAM_MAX_PER_IP, STREAM_MAX_QUEUE, STREAM_QUEUE_TIMEOUT, STREAM_FETCH_SLOTS, STREAM_TRUSTED_PROXIES
+
+logger = logging.getLogger(__name__)
+
+class StreamRejected(Exception):
+    """
+    Exception raised when a stream can't be admitted.
+    """
+    def __init__(self, message="Too many streams", retry_after=5):
+        self.message = message
+        self.retry_after = retry_after
+        super().__init__(self.message)
+
+def get_client_address(request) -> Optional[str]:
+    """
+    Return the address of the client of a request, or None when it can't be trusted.
+    Every proxy appends the address it got the request from to X-Forwarded-For,
+    so the client is the entry added by the outermost trusted proxy.
+    """
+    if STREAM_TRUSTED_PROXIES is None:
+        return None
+    if not STREAM_TRUSTED_PROXIES:
+        return request.remote
+    forwarded = [address.strip() for address in request.headers.get('X-Forwarded-For', '').split(',') if address.strip()]
+    if len(forwarded) < STREAM_TRUSTED_PROXIES:
+        return None
+    return forwarded[-STREAM_TRUSTED_PROXIES]
+
+def get_viewer_key(request) -> str:
+    """Return the client address of a request, or a key of its connection when it isn't known"""
+    return get_client_address(request) or f'connection-{id(request.transport or request)}'
+
+class StreamTicket:
+    def __init__(self, scheduler: "StreamScheduler", ip: Optional[str]):
+        """An admitted stream, released once when its response is done"""
+        self.scheduler = scheduler
+        self.ip = ip
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self.ip)
+
+class StreamScheduler:
+    def __init__(self, max_active: int, max_per_ip: int, max_queue: int, queue_timeout: float,
+                 fetch_slots: int, quantum: int = 1024 * 1024):
+        self.max_active = max_active
+        self.max_per_ip = max_per_ip
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.active_per_ip: Dict[str, int] = {}
+        self.waiting: deque = deque()
+        self.rejected = 0
+        # Deficit round-robin over the pending fetches of every flow
+        self.free_slots = fetch_slots
+        self.quantum = quantum
+        self.flows: "OrderedDict[tuple, deque]" = OrderedDict()
+        self.deficits: Dict[tuple, int] = {}
+
+    def over_ip_cap(self, ip: Optional[str]) -> bool:
+        return ip is not None and self.active_per_ip.get(ip, 0) >= self.max_per_ip
+
+    async def admit(self, ip: Optional[str]) -> StreamTicket:
+        """Admit a stream or raise StreamRejected, ip None leaves out the per address cap"""
+        if self.over_ip_cap(ip):
+            self.rejected += 1
+            raise StreamRejected("Too many streams from your address")
+        if self.active >= self.max_active or self.waiting:
+            if len(self.waiting) >= self.max_queue:
+                self.rejected += 1
+                raise StreamRejected()
+            future = asyncio.get_running_loop().create_future()
+            self.waiting.append(future)
+            try:
+                await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if future.done():
+                    # Admitted right as the wait ran out, hand the slot on
+                    self.release(None)
+                self.rejected += 1
+                raise StreamRejected()
+            except asyncio.CancelledError:
+                if future.done():
+                    self.release(None)
+                raise
+            finally:
+                if future in self.waiting:
+                    self.waiting.remove(future)
+            if self.over_ip_cap(ip):
+                # The address reached its cap while this stream was waiting
+                self.release(None)
+                self.rejected += 1
+                raise StreamRejected("Too many streams from your address")
+        else:
+            self.active += 1
+        if ip is not None:
+            self.active_per_ip[ip] = self.active_per_ip.get(ip, 0) + 1
+        return StreamTicket(self, ip)
+
+    def release(self, ip):
+        if ip is not None:
+            self.active_per_ip[ip] -= 1
+            if not self.active_per_ip[ip]:
+                del self.active_per_ip[ip]
+        # Pass the slot to the first stream waiting, if any
+        while self.waiting:
+            future = self.waiting.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def fetch_slot(self, flow: tuple, size: int):
+        """Hold one of the fetch slots while fetching size bytes for a flow"""
+        future = asyncio.get_running_loop().create_future()
+        if flow not in self.flows:
+            self.flows[flow] = deque()
+            self.deficits[flow] = 0
+        self.flows[flow].append((size, future))
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.free_slots += 1
+                self.dispatch()
+            raise
+        try:
+            yield
+        finally:
+            self.free_slots += 1
+            self.dispatch()
+
+    def dispatch(self):
+        while self.free_slots > 0 and self.flows:
+            flow, queue = next(iter(self.flows.items()))
+            size, future = queue[0]
+            if future.done():
+                # Cancelled while waiting
+                queue.popleft()
+            elif self.deficits[flow] < size:
+                self.deficits[flow] += self.quantum
+                self.flows.move_to_end(flow)
+                continue
+            else:
+                queue.popleft()
+                self.deficits[flow] -= size
+                self.free_slots -= 1
+                future.set_result(None)
+            if not queue:
+                del self.flows[flow]
+                del self.deficits[flow]
+
+    def get_stats(self) -> dict:
+        return {
+            'active': self.active,
+            'waiting': len(self.waiting),
+            'rejected': self.rejected,
+            'addresses': len(self.active_per_ip),
+            'free_fetch_slots': self.free_slots,
+            'queued_fetches': sum(len(queue) for queue in self.flows.values()),
+        }
+
+# Initialize the scheduler singleton
+stream_scheduler = StreamScheduler(STREAM_MAX_ACTIVE, STREAM_MAX_PER_IP, STREAM_MAX_QUEUE, STREAM_QUEUE_TIMEOUT, STREAM_FETCH_SLOTS)
@@ -0,0 +1,71 @@
+"""
+Accounting of the bytes fetched from Telegram versus the bytes delivered.
+
+Every stream response records how much its pipeline fetched upstream,
+prefetched chunks included, and how much reached the viewer. The gap is
+the bandwidth wasted by viewers that seek or leave mid-stream.
+"""
+import time
+from collections import deque
+from typing import List, Tuple
+
+class StreamTransfer:
+    __slots__ = ('ip', 'media_id', 'ranges', 'fetched', 'delivered', 'started', 'disconnected')
+
+    def __init__(self, ip: str, media_id: int, ranges: List[Tuple[int, int]]):
+        self.ip = ip
+        self.media_id = media_id
+        self.ranges = ranges
+        self.fetched = 0
+        self.delivered = 0
+        self.started = time.time()
+        self.disconnected = False
+
+    def to_dict(self) -> dict:
+        return {
+            'ip': self.ip,
+            'media_id': self.media_id,
+            'ranges': self.ranges,
+            'fetched': self.fetched,
+            'delivered': self.delivered,
+            'wasted': max(self.fetched - self.delivered, 0),
+            'disconnected': self.disconnected,
+            'duration': round(time.time() - self.started, 3),
+        }
+
+class StreamStats:
+    def __init__(self, history: int = 100):
+        self.active = set()
+        self.recent = deque(maxlen=history)
+        self.streams = 0
+        self.disconnects = 0
+        self.fetched = 0
+        self.delivered = 0
+
+    def start(self, ip: str, media_id: int, ranges: List[Tuple[int, int]]) -> StreamTransfer:
+        transfer = StreamTransfer(ip, media_id, ranges)
+        self.active.add(transfer)
+        return transfer
+
+    def finish(self, transfer: StreamTransfer):
+        self.active.discard(transfer)
+        self.streams += 1
+        self.disconnects += transfer.disconnected
+        self.fetched += transfer.fetched
+        self.delivered += transfer.delivered
+        self.recent.append(transfer.to_dict())
+
+    def get_stats(self) -> dict:
+        return {
+            'streams': self.streams,
+            'active': len(self.active),
+            'disconnects': self.disconnects,
+            'fetched': self.fetched,
+            'delivered': self.delivered,
+            'wasted': max(self.fetched - self.delivered, 0),
+            'waste_ratio': round(1 - self.delivered / self.fetched, 4) if self.fetched else 0,
+            'recent': list(self.recent),
+        }
+
+# Initialize the stats singleton
+stream_stats = StreamStats()